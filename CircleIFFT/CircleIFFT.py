@@ -1,47 +1,130 @@
-#CircleIFFT, by Zeno Dellby
-#installed by putting it into a folder in the PlugIns directory,
-#along with a file named __init__.py whose only contents are
-#
-#import CircleIFFT
-#
-
-import gettext
-
-import numpy as np
-import math
-
-# local libraries
-from nion.imaging import Image
-from nion.imaging import Operation
-from nion.swift import Application
-_ = gettext.gettext  # for translation
-
-#The operation class. Functions in it are called by Swift.
-class CircleIFFTOperation(Operation.Operation):
-    def __init__(self):
-        super(CircleIFFTOperation, self).__init__(_("Circle IFFT"), "circle-ifft-operation")
-        
-    #This is called whenever Swift wants to update the Circle IFFT image
-    def process(self, img):
-        radius = min(img.shape[0],img.shape[1])/2
-        w = max(512,radius*4) #the crop doesn't tell us what size the pre-cropped image would be
-        grad = np.zeros((w,w),dtype=img.dtype) #work on an image of the larger size
-        grad[(w - img.shape[0])/2:(w + img.shape[0])/2,(w - img.shape[1])/2:(w + img.shape[1])/2] = img[:,:] #put the FFT spot in the middle
-        icol, irow = np.ogrid[0:w,0:w] #and now for making the circle:
-        circle = np.zeros((w,w))
-        circle = ((irow-w/2)**2 + (icol-w/2)**2) < radius**2
-        grad = np.fft.ifft2(grad * circle)
-        return grad #Return an image to Swift, because that's what it wants
-        
-    
-#The following is code for making this into a process you can click on in the processing menu
- 
-def processing_circle_ifft(document_controller):
-    document_controller.add_processing_operation_by_id("circle-ifft-operation", prefix=_("Circle IFFT of "))
-
-def build_menus(document_controller): #makes the Show Circle IFFT Button
-    document_controller.processing_menu.add_menu_item(_("Circle IFFT"), lambda: processing_circle_ifft(document_controller))
-
-Application.app.register_menu_handler(build_menus) #called on import to make the Show Circle IFFT Button
-
-Operation.OperationManager().register_operation("circle-ifft-operation", lambda: CircleIFFTOperation())
+#CircleIFFT, by Zeno Dellby
+#installed by putting it into a folder in the PlugIns directory along with
+#this package's __init__.py, which adds the menu item and registers the
+#operation, and imports this module the first time the operation is made.
+
+import collections
+import functools
+import gettext
+
+import numpy as np
+import math
+
+try:
+    import scipy.fft as fft #keeps complex64 as complex64 and can transform in place
+except ImportError:
+    fft = None
+
+# local libraries
+from nion.imaging import Image
+from nion.imaging import Operation
+try:
+    from StackProcessing import StackProcessor #the StackProcessing plug-in, for 3d stacks
+except ImportError:
+    StackProcessor = None
+_ = gettext.gettext  # for translation
+
+#How many circle masks to keep around. They are only ever w*w bools.
+MASK_CACHE_SIZE = 8
+
+
+#The smallest size that is at least n and only has factors of 2, 3 and 5, which FFTs are fast at.
+def next_fast_length(n):
+    best = 2 * n
+    power2 = 1
+    while power2 < best:
+        power3 = power2
+        while power3 < best:
+            power5 = power3
+            while power5 < n:
+                power5 *= 5
+            best = min(best, power5)
+            power3 *= 3
+        power2 *= 2
+    return best
+
+
+#The operation circle_ifft_frames uses in a stack worker process, which keeps its masks and buffer
+#between frames. Frames done in the calling process use the calling operation instead.
+worker_operation = None
+
+#Does the Circle IFFT of each of frames into out in a stack worker process, for StackProcessor.process_stack.
+def circle_ifft_frames(output_size, single_precision, frames, out):
+    global worker_operation
+    if worker_operation is None:
+        worker_operation = CircleIFFTOperation()
+    worker_operation.output_size = output_size
+    worker_operation.single_precision = single_precision
+    worker_operation.process_frames(frames, out)
+
+
+#The operation class. Functions in it are called by Swift.
+class CircleIFFTOperation(Operation.Operation):
+    def __init__(self):
+        super(CircleIFFTOperation, self).__init__(_("Circle IFFT"), "circle-ifft-operation")
+        #Size of the output. None keeps the old max(512, 4*radius), "auto" uses the next FFT-friendly
+        #size that fits the crop, and a number is used as is (but never smaller than the crop).
+        self.output_size = None
+        self.single_precision = False #work in complex64 instead of complex128
+        self.__masks = collections.OrderedDict() #circle masks by (w, radius), most recently used last
+        self.__buffer = None #the padded buffer, kept between updates while the crop doesn't change size
+        self.__buffer_key = None
+        #3d data is a stack of frames, done on this many worker processes (None for one per CPU).
+        #progress, if set, is called with the number of frames done and the frame count; otherwise
+        #the progress of long stacks is logged.
+        self.stack_workers = None
+        self.progress = None
+
+    def get_output_size(self, img, radius):
+        crop_size = max(img.shape[0], img.shape[1])
+        if self.output_size is None:
+            return max(512, radius*4, crop_size) #the crop doesn't tell us what size the pre-cropped image would be
+        if self.output_size == "auto":
+            return next_fast_length(crop_size)
+        return max(int(self.output_size), crop_size)
+
+    def get_mask(self, w, radius): #a w*w image that is True inside the circle
+        mask = self.__masks.pop((w, radius), None)
+        if mask is None:
+            icol, irow = np.ogrid[0:w,0:w]
+            mask = ((irow-w//2)**2 + (icol-w//2)**2) < radius**2
+            while len(self.__masks) >= MASK_CACHE_SIZE:
+                self.__masks.popitem(last=False)
+        self.__masks[(w, radius)] = mask
+        return mask
+
+    #This is called whenever Swift wants to update the Circle IFFT image
+    def process(self, img):
+        if Image.is_data_3d(img) and (Image.is_data_complex_type(img) or Image.is_data_scalar_type(img)) and StackProcessor:
+            stack_frames = functools.partial(circle_ifft_frames, self.output_size, self.single_precision)
+            progress = self.progress or StackProcessor.ProgressLog(_("Circle IFFT"))
+            return StackProcessor.process_stack(img, stack_frames, self.stack_workers, progress=progress,
+                                                local_process_frames=self.process_frames)
+        return self.process_frame(img)
+
+    def process_frames(self, frames, out):
+        for i in range(len(frames)):
+            out[i] = self.process_frame(frames[i])
+
+    #The Circle IFFT of one 2d frame
+    def process_frame(self, img):
+        radius = min(img.shape[0],img.shape[1])//2
+        w = self.get_output_size(img, radius)
+        dtype = np.complex64 if self.single_precision else np.complex128
+        top = (w - img.shape[0])//2 #put the FFT spot in the middle
+        left = (w - img.shape[1])//2
+        region = (slice(top, top + img.shape[0]), slice(left, left + img.shape[1]))
+        #Outside of the crop the buffer is always zero, so a buffer of the same size can be reused
+        #and only the crop copied in, unless the transform was allowed to overwrite it.
+        key = (w, dtype, region)
+        grad = self.__buffer if self.__buffer_key == key else None
+        self.__buffer = self.__buffer_key = None
+        if grad is None:
+            grad = np.zeros((w,w),dtype=dtype) #work on an image of the larger size
+        np.multiply(img, self.get_mask(w, radius)[region], out=grad[region]) #cut out the circle while copying
+        if fft is not None:
+            return fft.ifft2(grad, overwrite_x=True) #Return an image to Swift, because that's what it wants
+        result = np.fft.ifft2(grad).astype(dtype, copy=False)
+        self.__buffer = grad #numpy doesn't touch its input, so the buffer can be used again
+        self.__buffer_key = key
+        return result
@@ -1,3 +1,33 @@
-# This file is a standard Python file to indicate that this directory is a single module.
-
-import CircleIFFT
\ No newline at end of file
+# This file is a standard Python file to indicate that this directory is a single module.
+# It adds the menu item and registers the operation without importing CircleIFFT, which is
+# imported the first time the operation is made so that loading the plug-in stays cheap.
+
+import gettext
+
+from nion.imaging import Operation
+from nion.swift import Application
+
+try:
+    from Profiling import Profiler
+except ImportError:  # the Profiling plug-in isn't installed
+    Profiler = None
+_ = gettext.gettext  # for translation
+
+
+def create_circle_ifft_operation():
+    import CircleIFFT
+    operation = CircleIFFT.CircleIFFTOperation()
+    if Profiler:
+        Profiler.instrument(operation, parameters=("output_size", "single_precision"))
+    return operation
+
+
+def processing_circle_ifft(document_controller):
+    document_controller.add_processing_operation_by_id("circle-ifft-operation", prefix=_("Circle IFFT of "))
+
+def build_menus(document_controller): #makes the Show Circle IFFT Button
+    document_controller.processing_menu.add_menu_item(_("Circle IFFT"), lambda: processing_circle_ifft(document_controller))
+
+Application.app.register_menu_handler(build_menus) #called on import to make the Show Circle IFFT Button
+
+Operation.OperationManager().register_operation("circle-ifft-operation", create_circle_ifft_operation)
@@ -1,11 +1,14 @@
 #ColorPhase, by Zeno Dellby
-#installed by putting it into a folder in the PlugIns directory,
-#along with a file named __init__.py whose only contents are
-#
-#import ColorPhase
-#
+#installed by putting it into a folder in the PlugIns directory along with
+#this package's __init__.py, which adds the menu item and registers the
+#operation, and imports this module the first time the operation is made.
 
+import collections
 import gettext
+import multiprocessing
+import multiprocessing.pool
+import os
+import threading
 
 import numpy as np
 import math
@@ -13,73 +16,282 @@ import math
 # local libraries
 from nion.imaging import Image
 from nion.imaging import Operation
-from nion.swift import Application
+try:
+    from StackProcessing import StackProcessor #the StackProcessing plug-in, for 3d stacks
+except ImportError:
+    StackProcessor = None
 _ = gettext.gettext  # for translation
 
+#Phase wraps are measured with these, not with exact multiples of pi, and the engine keeps them
+#so that the colours don't change.
+TWO_PI = 6.2831
+PI = 3.1415
+
+
+#Turns hue, saturation and intensity into colours by table lookup, so that the colouring doesn't
+#need any cos per pixel. Hue (-pi to pi), saturation (0 to 1) and intensity (0 to 1) are each
+#quantized to 256 levels. colors holds the full intensity colour for every hue/saturation pair,
+#and shades holds every colour value times every intensity, so an rgb image is two gathers.
+#Built once per process by color_lookup_table(), and can be used by other operations too.
+class ColorLookupTable(object):
+    LEVELS = 256
+
+    def __init__(self):
+        levels = self.LEVELS
+        H = (np.arange(levels) * (2*np.pi/levels) - np.pi)[:,np.newaxis]
+        S = (np.arange(levels) * (1.0/(levels-1)))[np.newaxis,:]
+        self.colors = np.empty((levels*levels, 3), dtype=np.uint8) #indexed by hue index*256 + saturation index
+        for c, offset in enumerate((0, -np.pi*2/3, np.pi*2/3)): #Blue, Green, Red
+            self.colors[:,c] = np.rint((S*(np.cos(H+offset)+1)*127.5+(1-S)*127.5)).ravel()
+        self.__shade_rows = self.colors.astype(np.uint16) * levels #where each colour's row of shades starts
+        color, intensity = np.ogrid[0:256, 0:levels]
+        self.shades = (color * intensity // (levels-1)).astype(np.uint8).ravel() #indexed by color*256 + intensity index
+
+    #Index into colors for each hue and saturation, written to out (uint16). H, S and scratch are
+    #float arrays of the same shape; S is left alone, H and scratch are overwritten.
+    def hue_saturation_index(self, H, S, out, scratch):
+        levels = self.LEVELS
+        H += np.pi
+        H *= levels/(2*np.pi)
+        H += 0.5 #so that truncating rounds
+        out[...] = H
+        out &= levels-1 #hue wraps around
+        out <<= 8
+        np.multiply(S, levels-1, out=scratch)
+        scratch += 0.5
+        np.minimum(scratch, levels-1, out=scratch)
+        out += scratch.astype(np.uint16)
+        return out
+
+    #Writes the rgb colours for each hue/saturation index and intensity (0 to 1) into the uint8
+    #array out. scratch is a float array the shape of I; it is overwritten.
+    def colorize(self, hue_saturation_index, I, out, scratch):
+        levels = self.LEVELS
+        np.multiply(I, levels-1, out=scratch)
+        scratch += 0.5 #so that truncating rounds
+        index = self.__shade_rows.take(hue_saturation_index, axis=0)
+        index += scratch.astype(np.uint16)[...,np.newaxis]
+        self.shades.take(index, out=out, mode="clip")
+        return out
+
+
+__color_lookup_table = None
+__color_lookup_table_lock = threading.Lock()
+
+def color_lookup_table():
+    global __color_lookup_table
+    with __color_lookup_table_lock:
+        if __color_lookup_table is None:
+            __color_lookup_table = ColorLookupTable()
+        return __color_lookup_table
+
+
+#Copies rows start to stop of a into out with a one pixel halo all around, wrapping around at
+#the edges, so that neighbours can be found with plain slices.
+def halo_block(a, start, stop, out):
+    w = a.shape[0]
+    out[1:-1,1:-1] = a[start:stop]
+    out[0,1:-1] = a[(start-1) % w]
+    out[-1,1:-1] = a[stop % w]
+    out[:,0] = out[:,-2]
+    out[:,-1] = out[:,1]
+    return out
+
+
+#Images with fewer pixels than this are always processed on the calling thread, since splitting
+#them up costs more than it saves.
+PARALLEL_MINIMUM_PIXELS = 512*512
+
+
+__thread_pool = None
+__thread_pool_process = None
+__thread_pool_lock = threading.Lock()
+
+#One pool of worker threads per process, one thread per CPU, shared by all of the engines. Pools
+#are never closed, so one per engine would leave its threads behind when the operation goes away.
+#A forked child gets a new pool, since the threads of the parent's don't exist in it.
+def thread_pool():
+    global __thread_pool, __thread_pool_process
+    with __thread_pool_lock:
+        if __thread_pool is None or __thread_pool_process != os.getpid():
+            __thread_pool = multiprocessing.pool.ThreadPool(multiprocessing.cpu_count())
+            __thread_pool_process = os.getpid()
+        return __thread_pool
+
+
+#Computes the phase gradient colouring of complex data. Magnitude, log magnitude and phase are
+#each computed once, and all of the intermediate arrays live in workspaces that are kept
+#between calls, so repeated updates of the same size don't allocate. Intermediates are float32
+#for complex64 data.
+#
+#Apart from the median and the max, everything only looks at the nearest neighbours, so after
+#those two are found the image is split into bands of rows, each processed with a one pixel
+#halo, on the shared pool of worker threads (numpy lets go of the GIL while it works). Set workers
+#to 1 to always stay on the calling thread; None uses one per CPU.
+class ColorPhaseEngine(object):
+    def __init__(self, workers=None):
+        self.workers = workers
+        self.__local = threading.local() #one workspace per thread
+        self.__color_map_indexes = collections.OrderedDict()
+
+    def buffer(self, name, shape, dtype): #a named workspace array, reallocated if the size or type changes
+        buffers = self.__local.__dict__.setdefault("buffers", dict())
+        buffer = buffers.get(name)
+        if buffer is None or buffer.shape != shape or buffer.dtype != dtype:
+            buffer = np.empty(shape, dtype=dtype)
+            buffers[name] = buffer
+        return buffer
+
+    #The hue/saturation index of the plain colour map only depends on the size, so it is kept
+    #for the last few sizes used.
+    def color_map_index(self, w, h):
+        index = self.__color_map_indexes.pop((w, h), None)
+        if index is None:
+            irow,icol = np.ogrid[0:w,0:h] #Makes 2 arrays, one of size w and one of size h
+            H = np.arctan2(w/2.0-irow,h/2.0-icol) #Makes a hue map from the direction to point irow,icol from point w/2,h/2
+            S = np.sqrt(np.square((irow-w//2)*np.sqrt(2)/w)+np.square((icol-h//2)*np.sqrt(2)/h)) #Saturation
+            index = color_lookup_table().hue_saturation_index(H, S, np.empty((w, h), np.uint16), np.empty((w, h)))
+            while len(self.__color_map_indexes) >= 4:
+                self.__color_map_indexes.popitem(last=False)
+        self.__color_map_indexes[(w, h)] = index
+        return index
+
+    def map(self, function, bands): #calls function for each band, in parallel if there are several
+        if len(bands) == 1:
+            return [function(band) for band in bands]
+        return thread_pool().map(function, bands)
+
+    #Weighted phase gradient along axis 0, as a number from 0 to 1, written to out. phase and
+    #inverse (1/abs) have one extra row of halo above and below out.
+    #Each direction is weighted by the noise, which goes as 1/abs, on the pixels it spans.
+    def gradient(self, phase, inverse, out, steps, weights, minus):
+        np.subtract(phase[1:], phase[:-1], out=steps) #steps[k] is the phase step from row k to k+1,
+        np.remainder(steps, TWO_PI, out=steps)         #so the step to the next pixel of out[i] is
+        plus = steps[1:]                               #steps[i+1] and from the previous one steps[i]
+        np.subtract(steps[:-1], plus, out=minus)
+        minus += PI
+        np.remainder(minus, TWO_PI, out=minus)
+        minus -= PI
+        np.add(inverse[1:], inverse[:-1], out=weights) #noise on each step
+        np.sqrt(weights, out=weights)
+        minus *= weights[1:]
+        np.add(weights[1:], weights[:-1], out=out)
+        minus /= out
+        minus += plus
+        np.remainder(minus, TWO_PI, out=out)
+        out /= math.pi
+        out /= 2
+        return out
+
+    #Colours rows start to stop of grad. magnitude is the log magnitude of those rows; phase and
+    #inverse (1/abs) are for the whole image.
+    def process_band(self, band, magnitude, phase, inverse, ave_intensity, max_intensity, grad):
+        start, stop = band
+        n = stop - start
+        h = phase.shape[1]
+        dtype = magnitude.dtype
+        phase = halo_block(phase, start, stop, self.buffer("phase_block", (n+2, h+2), dtype))
+        inverse = halo_block(inverse, start, stop, self.buffer("inverse_block", (n+2, h+2), dtype))
+
+        minus = self.buffer("minus", (n, h), dtype)
+        X = self.gradient(phase[:,1:-1], inverse[:,1:-1], self.buffer("x", (n, h), dtype),      #The realspace location,
+                          self.buffer("x_steps", (n+1, h), dtype), self.buffer("x_weights", (n+1, h), dtype), minus) #as a number from 0 to 1
+        Y = self.gradient(phase[1:-1].T, inverse[1:-1].T, self.buffer("y", (n, h), dtype).T, #transposed views, so that
+                          self.buffer("y_steps", (n, h+1), dtype).T, self.buffer("y_weights", (n, h+1), dtype).T, minus.T).T #all share a memory order
+
+        I = magnitude #Intensity, computed in place of the log magnitude
+        I -= ave_intensity
+        I /= max_intensity - ave_intensity
+        np.clip(I, 0, 1, out=I)
+        X -= 0.5
+        Y -= 0.5
+        S = np.hypot(X, Y, out=minus)  #Saturation
+        H = np.arctan2(X, Y, out=X)    #Hue
+        lookup_table = color_lookup_table()
+        index = lookup_table.hue_saturation_index(H, S, self.buffer("index", (n, h), np.uint16), Y)
+        lookup_table.colorize(index, I, grad[start:stop], Y)
+
+    def process(self, img, grad):
+        w = img.shape[0]
+        h = img.shape[1]
+        dtype = np.float32 if img.dtype == np.complex64 else np.float64
+        workers = self.workers or multiprocessing.cpu_count()
+        if w*h < PARALLEL_MINIMUM_PIXELS:
+            workers = 1
+        workers = max(min(workers, w), 1)
+        bands = [(w*i//workers, w*(i+1)//workers) for i in range(workers)]
+
+        #first everything that doesn't depend on the neighbours, so that the global statistics
+        #can be found
+        magnitude = self.buffer("magnitude", img.shape, dtype)
+        inverse = self.buffer("inverse", img.shape, dtype)
+        phase = self.buffer("phase", img.shape, dtype)
+        def pixelwise(band):
+            start, stop = band
+            np.abs(img[start:stop], out=magnitude[start:stop])
+            np.reciprocal(magnitude[start:stop], out=inverse[start:stop])
+            np.log(magnitude[start:stop], out=magnitude[start:stop]) #Putting the FFT on a log scale to see the dark parts more easily
+            np.arctan2(img[start:stop].imag, img[start:stop].real, out=phase[start:stop])
+        self.map(pixelwise, bands)
+        scratch = self.buffer("scratch", img.shape, dtype)
+        scratch[...] = magnitude
+        ave_intensity = np.median(scratch, overwrite_input=True) #To see the colors in the cool parts more clearly, ignore the noise in the dark
+        max_intensity = max(magnitude[0:w//2-2].max(), magnitude[w//2+2:].max(),       #not counting
+                            magnitude[0:,0:h//2-2].max(), magnitude[0:,h//2+2:].max()) #center pixels
+
+        #then everything else, band by band
+        self.map(lambda band: self.process_band(band, magnitude[band[0]:band[1]], phase, inverse, ave_intensity, max_intensity, grad), bands)
+        return grad
+
+
+#The operation color_phase_frames uses in a stack worker process. It uses one thread, since there
+#is a process per CPU already. Frames done in the calling process use the calling operation instead.
+worker_operation = None
+
+#Colours each of frames into out in a stack worker process, for StackProcessor.process_stack. Each
+#frame is scaled to its own intensity range, like a single image is.
+def color_phase_frames(frames, out):
+    global worker_operation
+    if worker_operation is None:
+        worker_operation = ColorPhaseOperation()
+        worker_operation.engine.workers = 1
+    worker_operation.process_frames(frames, out)
+
+
 #The operation class. Functions in it are called by Swift.
 class ColorPhaseOperation(Operation.Operation):
     def __init__(self):
         super(ColorPhaseOperation, self).__init__(_("Color Phase"), "color-phase-operation")
+        self.engine = ColorPhaseEngine() #keeps its workspace between updates
+        #3d data is a stack of frames, done on this many worker processes (None for one per CPU).
+        #progress, if set, is called with the number of frames done and the frame count; otherwise
+        #the progress of long stacks is logged.
+        self.stack_workers = None
+        self.progress = None
 
     #This is called whenever Swift wants to update the Color Phase image
     def process(self, img):
+        if Image.is_data_3d(img) and (Image.is_data_complex_type(img) or Image.is_data_scalar_type(img)) and StackProcessor:
+            progress = self.progress or StackProcessor.ProgressLog(_("Color Phase"))
+            return StackProcessor.process_stack(img, color_phase_frames, self.stack_workers, progress=progress,
+                                                local_process_frames=self.process_frames)
+        return self.process_frame(img)
+
+    def process_frames(self, frames, out):
+        for i in range(len(frames)):
+            out[i] = self.process_frame(frames[i])
+
+    #The Color Phase image of one 2d frame
+    def process_frame(self, img):
         grad = np.zeros(img.shape+(3L,),dtype=np.uint8) # rgb format
         # grad will be returned at the end, then Swift will identify it as rgb and display it as such.
         w = img.shape[0] #w and h are much shorter to read than img.shape[0] and img.shape[1]
         h = img.shape[1]
         if Image.is_data_complex_type(img): #If it's complex, we want to show the phase data, otherwise just a color map
-            ave_intensity = np.median(np.log(abs(img))) #To see the colors in the cool parts more clearly, ignore the noise in the dark
-            max_intensity = max(np.log(abs(img[0:w/2-2])).max(), np.log(abs(img[w/2+2:])).max(),       #not counting 
-                                np.log(abs(img[0:,0:h/2-2])).max(), np.log(abs(img[0:,h/2+2:])).max()) #center pixels
-            simgpx = img[range(1,w)+[0,]]       #shift image plus in x. It's a new view on the image, shifted one pixel
-            simgmx = img[[w-1,]+range(0,w-1)]   #over.
-            simgpy = img[:,range(1,h)+[0,]]
-            simgmy = img[:,[h-1,]+range(0,h-1)]
-            
-            nplusx  = np.sqrt(1/abs(img) + 1/abs(simgpx)) #Implicit looping lets it calculate an nplusx array in a
-            nminusx = np.sqrt(1/abs(img) + 1/abs(simgmx)) #single line
-            nplusy  = np.sqrt(1/abs(img) + 1/abs(simgpy))
-            nminusy = np.sqrt(1/abs(img) + 1/abs(simgmy))
-            
-            arcimg = np.arctan2(img.imag,img.real) #for SPEED, not that it helps as much as I hoped
-            dlambdaplusx  = (np.arctan2(simgpx.imag,simgpx.real)-arcimg) % 6.2831
-            dlambdaminusx = (arcimg-np.arctan2(simgmx.imag,simgmx.real)) % 6.2831
-            dlambdaplusy  = (np.arctan2(simgpy.imag,simgpy.real)-arcimg) % 6.2831
-            dlambdaminusy = (arcimg-np.arctan2(simgmy.imag,simgmy.real)) % 6.2831
-            
-            dlambdax = (dlambdaplusx + ((dlambdaminusx-dlambdaplusx+3.1415)%6.2831-3.1415)*nplusx / (nplusx+nminusx)) % 6.2831
-            dlambday = (dlambdaplusy + ((dlambdaminusy-dlambdaplusy+3.1415)%6.2831-3.1415)*nplusy / (nplusy+nminusy)) % 6.2831
-            
-            X = (dlambdax/math.pi)/2     #The realspace location, as a number from 0 to 1
-            Y = (dlambday/math.pi)/2
-            magnitude = np.log(abs(img)) #Putting the FFT on a log scale to see the dark parts more easily
-            I = np.maximum(np.minimum((magnitude-ave_intensity)/(max_intensity-ave_intensity),1),0) #Intensity
-            H = np.arctan2(X-0.5,Y-0.5)  #Hue
-            S = np.sqrt(np.square(X-0.5)+np.square(Y-0.5)) #Saturation
-            grad[:,:,0] = (S*(np.cos(H)+1)*127.5+(1-S)*127.5)*I           #Blue
-            grad[:,:,1] = (S*(np.cos(H-np.pi*2/3)+1)*127.5+(1-S)*127.5)*I #Green
-            grad[:,:,2] = (S*(np.cos(H+np.pi*2/3)+1)*127.5+(1-S)*127.5)*I #Red
+            self.engine.process(img, grad)
         else: #just overlay a color map onto it
             min_intensity = img.min()
             intensity_range = img.max() - min_intensity
-            irow,icol = np.ogrid[0:w,0:h] #Makes 2 arrays, one of size w and one of size h
-            H = np.arctan2(w/2.0-irow,h/2.0-icol) #Makes a hue map from the direction to point irow,icol from point w/2,h/2
-            S = np.sqrt(np.square((irow-w/2)*np.sqrt(2)/w)+np.square((icol-h/2)*np.sqrt(2)/h)) #Saturation
             I = (img*1.0 - min_intensity)/intensity_range #Intensity
-            grad[:,:,0] = (S*(np.cos(H)+1)*127.5+(1-S)*127.5)*I           #Blue
-            grad[:,:,1] = (S*(np.cos(H-np.pi*2/3)+1)*127.5+(1-S)*127.5)*I #Green
-            grad[:,:,2] = (S*(np.cos(H+np.pi*2/3)+1)*127.5+(1-S)*127.5)*I #Red
+            color_lookup_table().colorize(self.engine.color_map_index(w, h), I, grad, np.empty(img.shape))
         return grad #Return an image to Swift either way, because that's what it wants
-        
-    
-#The following is code for making this into a process you can click on in the processing menu
- 
-def processing_color_phase(document_controller):
-    document_controller.add_processing_operation_by_id("color-phase-operation", prefix=_("Color Phase of "))
-
-def build_menus(document_controller): #makes the Show Color Phase Button
-    document_controller.processing_menu.add_menu_item(_("Color Phase"), lambda: processing_color_phase(document_controller))
-
-Application.app.register_menu_handler(build_menus) #called on import to make the Show Color Phase Button
-
-Operation.OperationManager().register_operation("color-phase-operation", lambda: ColorPhaseOperation())
@@ -1,3 +1,33 @@
 # This file is a standard Python file to indicate that this directory is a single module.
+# It adds the menu item and registers the operation without importing ColorPhase, which is
+# imported the first time the operation is made so that loading the plug-in stays cheap.
 
-import ColorPhase
\ No newline at end of file
+import gettext
+
+from nion.imaging import Operation
+from nion.swift import Application
+
+try:
+    from Profiling import Profiler
+except ImportError:  # the Profiling plug-in isn't installed
+    Profiler = None
+_ = gettext.gettext  # for translation
+
+
+def create_color_phase_operation():
+    import ColorPhase
+    operation = ColorPhase.ColorPhaseOperation()
+    if Profiler:
+        Profiler.instrument(operation, parameters=("engine.workers",))
+    return operation
+
+
+def processing_color_phase(document_controller):
+    document_controller.add_processing_operation_by_id("color-phase-operation", prefix=_("Color Phase of "))
+
+def build_menus(document_controller): #makes the Show Color Phase Button
+    document_controller.processing_menu.add_menu_item(_("Color Phase"), lambda: processing_color_phase(document_controller))
+
+Application.app.register_menu_handler(build_menus) #called on import to make the Show Color Phase Button
+
+Operation.OperationManager().register_operation("color-phase-operation", create_color_phase_operation)
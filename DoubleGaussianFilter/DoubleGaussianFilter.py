@@ -9,22 +9,309 @@
 """
 
 # standard libraries
+import collections
+import functools
 import gettext
 import math
+import weakref
+import zlib
 
 # third party libraries
 import numpy
 import scipy.fftpack
+import scipy.ndimage
+
+try:
+    # scipy.fft (scipy >= 1.4) keeps single precision and can transform in place.
+    import scipy.fft as real_fft
+except ImportError:
+    real_fft = None
 
 # local libraries
-from nion.swift import Application
 from nion.imaging import Image
 from nion.imaging import Operation
 
+try:
+    # the StackProcessing plug-in, for 3d stacks.
+    from StackProcessing import StackProcessor
+except ImportError:
+    StackProcessor = None
+
 
 _ = gettext.gettext
 
 
+# default memory budget for cached filter kernels, in bytes.
+KERNEL_CACHE_BUDGET = 256 * 1024 * 1024
+
+# real space kernel taps smaller than this fraction of the largest tap are dropped.
+SEPARABLE_KERNEL_TOLERANCE = 1e-6
+
+# the separable backend processes the data in bands of rows of at most this many bytes, so
+# memory-mapped data larger than memory can be filtered.
+SEPARABLE_BAND_BYTES = 64 * 1024 * 1024
+
+BACKENDS = ("fft", "separable")
+
+
+# return the coordinates used for the filter along one axis of length n, ordered like the
+# unshifted output of fft2 (zero frequency first). the values are the same as the ones the
+# filter has always used in shifted order: linspace(floor(-n/2), floor(n/2), n).
+def frequency_coordinates(n):
+    shifted = numpy.linspace(int(math.floor(-n / 2.0)), int(math.floor(n / 2.0)), n)
+    return scipy.fftpack.ifftshift(shifted)
+
+
+# a checksum of all of the data, so that any in-place change to a cached input is noticed. it
+# reads the data once, which is cheap next to the forward FFT it saves.
+def data_checksum(data):
+    return zlib.crc32(numpy.ascontiguousarray(data).view(numpy.uint8)) & 0xffffffff
+
+
+# forward real-to-complex transform. only the non-negative half of the last axis is returned.
+def rfft2(data, complex_dtype):
+    if real_fft is not None:
+        return real_fft.rfft2(data)
+    # numpy.fft always computes in double precision.
+    return numpy.fft.rfft2(data).astype(complex_dtype, copy=False)
+
+
+# inverse of rfft2. the spectrum may be overwritten.
+def irfft2(spectrum, shape, real_dtype):
+    if real_fft is not None:
+        return real_fft.irfft2(spectrum, s=shape, overwrite_x=True)
+    return numpy.fft.irfft2(spectrum, s=shape).astype(real_dtype, copy=False)
+
+
+class DoubleGaussianFilterEngine(object):
+    """
+        Compute the double Gaussian filter, caching intermediate results between calls.
+
+        The filter uses a real-to-complex transform, so only half of the spectrum is computed
+        and stored. The forward spectrum is cached for the most recent input, keyed by the
+        identity of the input array and a checksum of its contents, so changing only the
+        filter parameters costs one multiply and one inverse FFT. Call invalidate to drop the
+        cached spectrum explicitly.
+
+        Filter kernels are built for the half plane directly in unshifted frequency order and
+        kept in an LRU cache keyed by shape and parameters and bounded by a memory budget in
+        bytes. The per-axis squared coordinates are cached by shape. The product of spectrum
+        and kernel is written into a workspace that is reused between calls.
+
+        Set single_precision to compute in float32/complex64, halving memory and, with
+        scipy.fft available, transform time.
+
+        The same filter can also be computed in real space: each Gaussian is the outer product
+        of two 1d kernels, so it can be applied as two 1d convolutions. backend selects "fft"
+        (the default) or "separable". The separable backend is not faster: the coordinates are
+        stretched by linspace and the Gaussians are cut off at Nyquist, so the real space kernels
+        ring and are around a hundred taps long at any sigma. It is for streaming: it works on
+        bands of rows into out, so memory-mapped data does not have to fit in memory.
+    """
+
+    def __init__(self, kernel_cache_budget=KERNEL_CACHE_BUDGET, single_precision=False, backend="fft"):
+        self.kernel_cache_budget = kernel_cache_budget
+        self.single_precision = single_precision
+        self.backend = backend
+        self.__spectrum_data_ref = None
+        self.__spectrum_key = None
+        self.__spectrum = None
+        self.__coordinates = dict()
+        self.__kernels = collections.OrderedDict()
+        self.__kernels_nbytes = 0
+        self.__workspace = None
+        self.__spatial_kernels = collections.OrderedDict()
+
+    # forget the spectrum of the last input, e.g. after changing it in place.
+    def invalidate(self):
+        self.__spectrum_data_ref = None
+        self.__spectrum_key = None
+        self.__spectrum = None
+
+    def clear(self):
+        self.__spectrum_data_ref = None
+        self.__spectrum_key = None
+        self.__spectrum = None
+        self.__coordinates.clear()
+        self.__kernels.clear()
+        self.__kernels_nbytes = 0
+        self.__workspace = None
+        self.__spatial_kernels.clear()
+
+    @property
+    def real_dtype(self):
+        return numpy.dtype(numpy.float32 if self.single_precision else numpy.float64)
+
+    @property
+    def complex_dtype(self):
+        return numpy.dtype(numpy.complex64 if self.single_precision else numpy.complex128)
+
+    def __spectrum_cache_key(self, data):
+        return data.shape, data.dtype.str, self.real_dtype.str, data_checksum(data)
+
+    def __get_spectrum(self, data):
+        key = self.__spectrum_cache_key(data)
+        if self.__spectrum_data_ref is not None and self.__spectrum_data_ref() is data and self.__spectrum_key == key:
+            return self.__spectrum
+        # the fft produces a new array, so the input does not need to be copied first.
+        spectrum = rfft2(data.astype(self.real_dtype, copy=False), self.complex_dtype)
+        # a weak reference so the cache doesn't keep old frames alive.
+        self.__spectrum_data_ref = weakref.ref(data)
+        self.__spectrum_key = key
+        self.__spectrum = spectrum
+        return spectrum
+
+    # squared coordinates along each axis, normalized so the filter sigmas are in units of
+    # half the height of the data.
+    def __get_squared_coordinates(self, shape):
+        squared_coordinates = self.__coordinates.get(shape)
+        if squared_coordinates is None:
+            scale = shape[0] * 0.5
+            squared_coordinates = tuple(numpy.square(frequency_coordinates(n) / scale) for n in shape)
+            self.__coordinates[shape] = squared_coordinates
+        return squared_coordinates
+
+    # build the kernel for the half plane returned by rfft2.
+    def __build_kernel(self, shape, sigma1, sigma2, weight2):
+        yy2, xx2 = self.__get_squared_coordinates(shape)
+        half_width = shape[1] // 2 + 1
+        # index of the negative frequency for each frequency along each axis.
+        yy_negative = -numpy.arange(shape[0]) % shape[0]
+        xx_negative = (-numpy.arange(shape[1]) % shape[1])[:half_width]
+        kernel = numpy.zeros((shape[0], half_width), dtype=self.real_dtype)
+        for sigma, weight in ((sigma1, 1.0), (sigma2, -(1.0 - weight2))):
+            # exp(-0.5 * rr^2 / sigma^2) separates into a product of per-axis factors.
+            yy_factor = numpy.exp(-0.5 * yy2 / sigma ** 2)
+            xx_factor = numpy.exp(-0.5 * xx2 / sigma ** 2)
+            # the coordinates are not exactly symmetric about zero frequency, and the filter
+            # has always kept only the real part of the inverse transform. that is the same as
+            # filtering with the average of the kernel at f and -f, which is what a
+            # real-to-complex transform needs.
+            kernel += (0.5 * weight) * numpy.outer(yy_factor, xx_factor[:half_width])
+            kernel += (0.5 * weight) * numpy.outer(yy_factor[yy_negative], xx_factor[xx_negative])
+        return kernel
+
+    def __get_kernel(self, shape, sigma1, sigma2, weight2):
+        key = (shape, sigma1, sigma2, weight2, self.real_dtype.str)
+        kernel = self.__kernels.pop(key, None)
+        if kernel is None:
+            kernel = self.__build_kernel(shape, sigma1, sigma2, weight2)
+            if kernel.nbytes > self.kernel_cache_budget:
+                return kernel  # too big to ever fit; don't flush the cache for it
+            self.__kernels_nbytes += kernel.nbytes
+            while self.__kernels_nbytes > self.kernel_cache_budget:
+                _key, evicted_kernel = self.__kernels.popitem(last=False)
+                self.__kernels_nbytes -= evicted_kernel.nbytes
+        self.__kernels[key] = kernel  # most recently used goes last
+        return kernel
+
+    def __get_workspace(self, shape, dtype):
+        workspace = self.__workspace
+        if workspace is None or workspace.shape != shape or workspace.dtype != dtype:
+            workspace = numpy.empty(shape, dtype=dtype)
+            self.__workspace = workspace
+        return workspace
+
+    # real space kernel along one axis for one of the Gaussians: the inverse transform of the
+    # frequency space factor, truncated to the taps that matter. the coordinates are not
+    # exactly symmetric, so the kernel is complex; the imaginary part is None if negligible.
+    def __get_spatial_kernel(self, shape, axis, sigma):
+        key = (shape, axis, sigma)
+        spatial_kernel = self.__spatial_kernels.pop(key, None)
+        if spatial_kernel is None:
+            n = shape[axis]
+            squared_coordinates = self.__get_squared_coordinates(shape)[axis]
+            taps = numpy.fft.ifft(numpy.exp(-0.5 * squared_coordinates / sigma ** 2))
+            magnitude = numpy.abs(taps)
+            offsets = numpy.minimum(numpy.arange(n), n - numpy.arange(n))  # circular distance from 0
+            significant = offsets[magnitude > SEPARABLE_KERNEL_TOLERANCE * magnitude.max()]
+            radius = min(int(significant.max()), (n - 1) // 2)
+            taps = taps[numpy.arange(-radius, radius + 1) % n]
+            imag = taps.imag if numpy.abs(taps.imag).max() > SEPARABLE_KERNEL_TOLERANCE * magnitude.max() else None
+            spatial_kernel = taps.real, imag
+            while len(self.__spatial_kernels) >= 64:
+                self.__spatial_kernels.popitem(last=False)
+        self.__spatial_kernels[key] = spatial_kernel
+        return spatial_kernel
+
+    # list the 1d convolution passes as (y taps, x taps, weight). the real part of the outer
+    # product of complex kernels is yr*xr - yi*xi, so a complex pair needs two passes.
+    def __get_separable_passes(self, shape, sigma1, sigma2, weight2):
+        passes = list()
+        for sigma, weight in ((sigma1, 1.0), (sigma2, -(1.0 - weight2))):
+            y_real, y_imag = self.__get_spatial_kernel(shape, 0, sigma)
+            x_real, x_imag = self.__get_spatial_kernel(shape, 1, sigma)
+            passes.append((y_real, x_real, weight))
+            if y_imag is not None and x_imag is not None:
+                passes.append((y_imag, x_imag, -weight))
+        return passes
+
+    def __filter_separable(self, data, passes, out):
+        n0, n1 = data.shape
+        real_dtype = self.real_dtype
+        if out is None:
+            out = numpy.empty(data.shape, dtype=real_dtype)
+        halo = max(len(y_taps) // 2 for y_taps, x_taps, weight in passes)
+        band_rows = max(SEPARABLE_BAND_BYTES // (n1 * real_dtype.itemsize) - 2 * halo, 1)
+        for row_start in range(0, n0, band_rows):
+            row_stop = min(row_start + band_rows, n0)
+            # read the band plus halo rows above and below, wrapping around like the FFT does.
+            rows = numpy.arange(row_start - halo, row_stop + halo) % n0
+            band = numpy.take(data, rows, axis=0).astype(real_dtype, copy=False)
+            result = numpy.zeros((row_stop - row_start, n1), dtype=real_dtype)
+            for y_taps, x_taps, weight in passes:
+                partial = scipy.ndimage.convolve1d(band, x_taps.astype(real_dtype), axis=1, mode="wrap")
+                partial = scipy.ndimage.convolve1d(partial, y_taps.astype(real_dtype), axis=0, mode="wrap")
+                result += weight * partial[halo:halo + row_stop - row_start]
+            out[row_start:row_stop] = result
+        return out
+
+    def __filter_fft(self, data, sigma1, sigma2, weight2):
+        spectrum = self.__get_spectrum(data)
+        kernel = self.__get_kernel(data.shape, sigma1, sigma2, weight2)
+        # the kernel is in unshifted order, so no fftshift/ifftshift is needed. the cached
+        # spectrum must stay intact, so the product goes into the workspace, which the
+        # inverse transform is then free to overwrite.
+        product = self.__get_workspace(spectrum.shape, spectrum.dtype)
+        numpy.multiply(spectrum, kernel, out=product)
+        return irfft2(product, data.shape, self.real_dtype)
+
+    # filter the data. out, if given, receives the result (the separable backend writes it band
+    # by band, so it can be a memory-mapped array).
+    def filter(self, data, sigma1, sigma2, weight2, out=None):
+        if self.backend not in BACKENDS:
+            raise ValueError("backend must be one of %s, not %r" % (", ".join(BACKENDS), self.backend))
+        if self.backend == "separable":
+            passes = self.__get_separable_passes(data.shape, sigma1, sigma2, weight2)
+            return self.__filter_separable(data, passes, out)
+        result = self.__filter_fft(data, sigma1, sigma2, weight2)
+        if out is not None:
+            out[:] = result
+            return out
+        return result
+
+
+# filter each of frames into out with engine.
+def filter_frames_with_engine(engine, sigma1, sigma2, weight2, frames, out):
+    for i in range(len(frames)):
+        out[i] = engine.filter(frames[i], sigma1, sigma2, weight2)
+
+
+# the engine filter_frames uses in a stack worker process, which keeps its kernels between frames.
+# frames filtered in the calling process use the operation's own engine instead.
+worker_engine = None
+
+
+# filter each of frames into out in a stack worker process, for StackProcessor.process_stack.
+def filter_frames(sigma1, sigma2, weight2, single_precision, backend, frames, out):
+    global worker_engine
+    if worker_engine is None:
+        worker_engine = DoubleGaussianFilterEngine()
+    worker_engine.single_precision = single_precision
+    worker_engine.backend = backend
+    filter_frames_with_engine(worker_engine, sigma1, sigma2, weight2, frames, out)
+
+
 class DoubleGaussianFilterOperation(Operation.Operation):
     def __init__(self):
 
@@ -39,6 +326,13 @@ class DoubleGaussianFilterOperation(Operation.Operation):
         self.sigma1 = 0.3
         self.sigma2 = 0.3
         self.weight2 = 0.3
+        # keeps the spectrum of the last input and recent kernels so parameter changes are cheap.
+        self.engine = DoubleGaussianFilterEngine()
+        # 3d data is a stack of frames, filtered on this many worker processes (None for one per
+        # CPU). progress, if set, is called with the number of frames done and the frame count;
+        # otherwise the progress of long stacks is logged.
+        self.stack_workers = None
+        self.progress = None
 
     # process is called to process the data. this version does not change the data shape
     # or data type. if it did, we would need to provide another function to describe the
@@ -48,57 +342,31 @@ class DoubleGaussianFilterOperation(Operation.Operation):
         # only works with 2d, scalar data
         if Image.is_data_2d(data) and Image.is_data_scalar_type(data):
 
-            # make a copy of the data so that other threads can use data while we're processing
-            # otherwise numpy puts a lock on the data.
-            data_copy = data.copy()
-
             # grab our parameters. ideally this could just access the member variables directly,
             # but it doesn't work that way (yet).
             sigma1 = self.get_property("sigma1")
             sigma2 = self.get_property("sigma2")
             weight2 = self.get_property("weight2")
 
-            # first calculate the FFT
-            fft_data = scipy.fftpack.fftshift(scipy.fftpack.fft2(data_copy))
+            # the engine caches the FFT of the data and the filter kernel, so only the changed
+            # parts are recalculated.
+            return self.engine.filter(data, sigma1, sigma2, weight2)
 
-            # next, set up xx, yy arrays to be linear indexes for x and y coordinates ranging
-            # from -width/2 to width/2 and -height/2 to height/2.
-            yy_min = int(math.floor(-data.shape[0] / 2))
-            yy_max = int(math.floor(data.shape[0] / 2))
-            xx_min = int(math.floor(-data.shape[1] / 2))
-            xx_max = int(math.floor(data.shape[1] / 2))
-            xx, yy = numpy.meshgrid(numpy.linspace(yy_min, yy_max, data.shape[0]),
-                                    numpy.linspace(xx_min, xx_max, data.shape[1]))
+        elif Image.is_data_3d(data) and Image.is_data_scalar_type(data) and StackProcessor:
 
-            # calculate the pixel distance from the center
-            rr = numpy.sqrt(numpy.square(xx) + numpy.square(yy)) / (data.shape[0] * 0.5)
-
-            # finally, apply a filter to the Fourier space data.
-            filter = numpy.exp(-0.5 * numpy.square(rr / sigma1)) - (1.0 - weight2) * numpy.exp(
-                -0.5 * numpy.square(rr / sigma2))
-            filtered_fft_data = fft_data * filter
+            sigma1 = self.get_property("sigma1")
+            sigma2 = self.get_property("sigma2")
+            weight2 = self.get_property("weight2")
 
-            # and then do invert FFT and take the real value.
-            return scipy.fftpack.ifft2(scipy.fftpack.ifftshift(filtered_fft_data)).real
+            # filter each frame, on a pool of worker processes for large stacks. the frames
+            # filtered here use this operation's engine.
+            filter_stack_frames = functools.partial(filter_frames, sigma1, sigma2, weight2,
+                                                    self.engine.single_precision, self.engine.backend)
+            filter_local_frames = functools.partial(filter_frames_with_engine, self.engine, sigma1, sigma2, weight2)
+            progress = self.progress or StackProcessor.ProgressLog(_("Double Gaussian Filter"))
+            return StackProcessor.process_stack(data, filter_stack_frames, self.stack_workers, progress=progress,
+                                                local_process_frames=filter_local_frames)
 
         else:
-            # not 2d data.
+            # not 2d data or a stack of it.
             raise NotImplementedError()
-
-
-# The following is code for making this into a process you can access from the processing menu
-
-def processing_double_gaussian_filter(document_controller):
-    return document_controller.add_processing_operation_by_id("double-gaussian-filter-operation",
-                                                              prefix=_("Double Gaussian Filter of "))
-
-
-def build_menus(document_controller):
-    document_controller.processing_menu.add_menu_item(_("Double Gaussian Filter"),
-                                                      lambda: processing_double_gaussian_filter(document_controller))
-
-
-Application.app.register_menu_handler(build_menus)  # called on import to make the Show Color Phase Button
-
-Operation.OperationManager().register_operation("double-gaussian-filter-operation",
-                                                lambda: DoubleGaussianFilterOperation())
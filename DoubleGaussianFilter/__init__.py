@@ -1,3 +1,40 @@
 # This file is a standard Python file to indicate that this directory is a single module.
+# It adds the menu item and registers the operation without importing DoubleGaussianFilter (and
+# with it scipy), which is imported the first time the operation is made.
 
-import DoubleGaussianFilter
\ No newline at end of file
+import gettext
+
+from nion.imaging import Operation
+from nion.swift import Application
+
+try:
+    from Profiling import Profiler
+except ImportError:  # the Profiling plug-in isn't installed
+    Profiler = None
+
+_ = gettext.gettext
+
+
+def create_double_gaussian_filter_operation():
+    import DoubleGaussianFilter
+    operation = DoubleGaussianFilter.DoubleGaussianFilterOperation()
+    if Profiler:
+        Profiler.instrument(operation, parameters=("sigma1", "sigma2", "weight2", "engine.backend",
+                                                   "engine.single_precision"))
+    return operation
+
+
+def processing_double_gaussian_filter(document_controller):
+    return document_controller.add_processing_operation_by_id("double-gaussian-filter-operation",
+                                                              prefix=_("Double Gaussian Filter of "))
+
+
+def build_menus(document_controller):
+    document_controller.processing_menu.add_menu_item(_("Double Gaussian Filter"),
+                                                      lambda: processing_double_gaussian_filter(document_controller))
+
+
+Application.app.register_menu_handler(build_menus)  # called on import to make the Double Gaussian Filter Button
+
+Operation.OperationManager().register_operation("double-gaussian-filter-operation",
+                                                create_double_gaussian_filter_operation)
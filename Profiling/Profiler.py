@@ -0,0 +1,205 @@
+"""
+    Timing of the processing operations and the video acquisition loop.
+
+    The plug-ins pass each operation they make to instrument, which wraps its process method.
+    Nothing is recorded until profiling is enabled, and while it is disabled the wrapper only
+    checks a flag before calling through. From the Python console in Swift:
+
+        from Profiling import Profiler
+        Profiler.profiler.enable()              # or enable(trace_memory=True, path="ops.jsonl")
+        ...
+        Profiler.profiler.summary()             # calls and times per operation
+        Profiler.profiler.get_records("double-gaussian-filter-operation")
+        Profiler.profiler.dump("ops.jsonl")     # the kept records as JSON lines
+
+    Setting the PROFILE_OPERATIONS environment variable enables profiling when Swift starts, and
+    setting PROFILE_OPERATIONS_LOG to a file name also appends each record to that file.
+
+    Memory tracing uses tracemalloc, which is only in Python 3.4 and later. Under Python 2,
+    enable(trace_memory=True) logs a warning and records times only, without allocated_bytes.
+"""
+
+# standard libraries
+import collections
+import functools
+import json
+import logging
+import os
+import threading
+import time
+
+try:
+    import tracemalloc  # Python 3.4 and later
+except ImportError:
+    tracemalloc = None
+
+
+RECORD_LIMIT = 10000  # records kept in memory, most recent last
+
+timer = getattr(time, "perf_counter", time.time)
+
+
+# the properties in an operation's description, which Swift sets through set_property. their values
+# are only to be had from get_property; the attributes of the same name keep their first values.
+def get_property_names(operation):
+    description = getattr(operation, "description", None) or list()
+    return [item["property"] for item in description if "property" in item]
+
+
+def get_parameter(obj, name, property_names=()):
+    if name in property_names:
+        value = obj.get_property(name)
+    else:
+        # dotted names reach into attributes, e.g. "engine.backend"
+        value = obj
+        for part in name.split("."):
+            value = getattr(value, part, None)
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    try:
+        return value.item()  # numpy scalars
+    except AttributeError:
+        return repr(value)
+
+
+class OperationProfiler(object):
+    """
+        Keeps a record of each call made while enabled: the operation id, wall clock start time,
+        duration, shape and dtype of the data, the operation's parameters, the thread and, when
+        tracing memory, the bytes allocated during the call.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.trace_memory = False
+        self.__records = collections.deque(maxlen=RECORD_LIMIT)
+        self.__log_file = None
+        self.__lock = threading.Lock()
+
+    def enable(self, trace_memory=False, path=None):
+        """
+            Start recording. With path, each record is also appended to that JSON lines file.
+            trace_memory adds the bytes allocated during each call, where tracemalloc is available.
+        """
+        with self.__lock:
+            if self.__log_file:
+                self.__log_file.close()
+            self.__log_file = open(path, "a") if path else None
+        # tracemalloc is for the whole process, so with other threads allocating too the numbers
+        # are only a guide. it also slows allocation down, so is off unless asked for.
+        if trace_memory and not tracemalloc:
+            logging.warning("memory tracing needs tracemalloc (Python 3.4 and later); recording times only")
+        self.trace_memory = bool(trace_memory and tracemalloc)
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+        if self.trace_memory:
+            self.trace_memory = False
+            tracemalloc.stop()
+        with self.__lock:
+            if self.__log_file:
+                self.__log_file.close()
+                self.__log_file = None
+
+    def clear(self):
+        self.__records.clear()
+
+    def get_records(self, operation_id=None):
+        records = list(self.__records)
+        if operation_id is not None:
+            records = [record for record in records if record["operation_id"] == operation_id]
+        return records
+
+    def summary(self):
+        """Call count, total, mean and maximum time in seconds, by operation id."""
+        summary = dict()
+        for record in list(self.__records):
+            entry = summary.setdefault(record["operation_id"], {"calls": 0, "total_time": 0.0, "max_time": 0.0})
+            entry["calls"] += 1
+            entry["total_time"] += record["duration"]
+            entry["max_time"] = max(entry["max_time"], record["duration"])
+        for entry in summary.values():
+            entry["mean_time"] = entry["total_time"] / entry["calls"]
+        return summary
+
+    def dump(self, path):
+        """Write the kept records to path as JSON lines, replacing the file."""
+        with open(path, "w") as f:
+            for record in list(self.__records):
+                f.write(json.dumps(record) + "\n")
+
+    def add_record(self, record):
+        self.__records.append(record)
+        if self.__log_file:
+            line = json.dumps(record) + "\n"
+            with self.__lock:
+                if self.__log_file:
+                    self.__log_file.write(line)
+                    self.__log_file.flush()
+
+    def call(self, method, args, kwargs, operation, operation_id, parameters, property_names, get_data):
+        record = {
+            "operation_id": operation_id,
+            "time": time.time(),
+            "thread": threading.current_thread().name,
+            "parameters": dict((name, get_parameter(operation, name, property_names)) for name in parameters),
+        }
+        trace_memory = self.trace_memory and tracemalloc.is_tracing()
+        if trace_memory:
+            if hasattr(tracemalloc, "reset_peak"):  # Python 3.9 and later
+                tracemalloc.reset_peak()
+            memory_before = tracemalloc.get_traced_memory()[0]
+        start = timer()
+        result = method(*args, **kwargs)
+        record["duration"] = timer() - start
+        if trace_memory:
+            current, peak = tracemalloc.get_traced_memory()
+            # without reset_peak, the peak may be from before the call; the memory kept is all
+            # that can be told then.
+            record["allocated_bytes"] = (peak if hasattr(tracemalloc, "reset_peak") else current) - memory_before
+        data = get_data(args, result)
+        record["shape"] = list(data.shape) if hasattr(data, "shape") else None
+        record["dtype"] = str(data.dtype) if hasattr(data, "dtype") else None
+        self.add_record(record)
+        return result
+
+
+profiler = OperationProfiler()
+
+if os.environ.get("PROFILE_OPERATIONS") or os.environ.get("PROFILE_OPERATIONS_LOG"):
+    profiler.enable(path=os.environ.get("PROFILE_OPERATIONS_LOG"))
+
+
+def first_argument(args, result):
+    return args[0] if args else None
+
+
+def instrument(operation, method_name="process", operation_id=None, parameters=None, get_data=first_argument):
+    """
+        Replace operation's method_name with one that is timed while profiling is enabled, and
+        return operation.
+
+        parameters are the names of the values to record with each call; by default the
+        properties in the operation's description. Those properties are read with get_property,
+        and other names are attributes. get_data(args, result) returns the array whose shape and
+        dtype are recorded; by default the first argument.
+    """
+    method = getattr(operation, method_name)
+    if operation_id is None:
+        operation_id = getattr(operation, "operation_id", None) or type(operation).__name__
+    property_names = frozenset(get_property_names(operation)) if hasattr(operation, "get_property") else frozenset()
+    if parameters is None:
+        parameters = get_property_names(operation)
+    parameters = tuple(parameters)
+
+    @functools.wraps(method)
+    def instrumented(*args, **kwargs):
+        if not profiler.enabled:
+            return method(*args, **kwargs)
+        return profiler.call(method, args, kwargs, operation, operation_id, parameters, property_names, get_data)
+
+    setattr(operation, method_name, instrumented)
+    return operation
@@ -0,0 +1,3 @@
+# Timing of the processing operations of the other plug-ins; see Profiler.py.
+
+import Profiler
@@ -0,0 +1,150 @@
+"""
+    Processing of 3-D stacks, frame by frame, on a pool of worker processes.
+
+    The operations hand process_stack a function that processes a run of frames into an output
+    array, e.g. functools.partial(filter_frames, sigma1, sigma2, weight2). The stack is copied
+    once into shared memory and the output is allocated in shared memory before the workers
+    start, so frames are never pickled; the workers are only sent the range of frames to do.
+    The function must be picklable (module level) where processes are spawned rather than forked.
+
+    The frames done in this process, the first of every stack and all of the frames of a stack
+    too small for the pool, can be done by a second function that uses the calling operation's
+    own state (local_process_frames). Module level state is then only ever used in the workers,
+    where there is one stack at a time, and not shared by operations working at the same time.
+"""
+
+# standard libraries
+import ctypes
+import logging
+import multiprocessing
+import time
+
+# third party libraries
+import numpy
+
+
+WORKERS = None  # worker processes; None for one per CPU
+POOL_MINIMUM_PIXELS = 4096 * 4096  # smaller stacks are done in this process; starting the pool costs more
+CHUNKS_PER_WORKER = 4  # chunks per worker, so that a slow chunk doesn't hold up the end
+PROGRESS_LOG_INTERVAL = 2.0  # seconds between ProgressLog messages
+
+
+# The shared arrays of the stack being processed and the function to apply, set in each worker
+# by initialize_worker.
+worker_state = dict()
+
+
+def in_worker():
+    """True in a stack worker process, where processing should use a single thread."""
+    return bool(worker_state)
+
+
+class ProgressLog(object):
+    """
+        A progress callback for process_stack that logs the frames done, as "title: done of count
+        frames", at most every interval seconds (PROGRESS_LOG_INTERVAL by default) and when the
+        stack is done. Nothing is logged for a stack done in less than interval seconds. The
+        operations use it unless given their own progress function.
+    """
+
+    def __init__(self, title, interval=None):
+        self.title = title
+        self.interval = PROGRESS_LOG_INTERVAL if interval is None else interval
+        self.__start_time = time.time()
+        self.__last_time = self.__start_time
+
+    def __call__(self, done, count):
+        now = time.time()
+        if now - self.__last_time >= self.interval or (done == count and now - self.__start_time >= self.interval):
+            logging.info("%s: %d of %d frames", self.title, done, count)
+            self.__last_time = now
+
+
+def shared_array(shape, dtype):
+    dtype = numpy.dtype(dtype)
+    buffer = multiprocessing.RawArray(ctypes.c_uint8, max(int(numpy.prod(shape)) * dtype.itemsize, 1))
+    return buffer, numpy.frombuffer(buffer, dtype=dtype, count=int(numpy.prod(shape))).reshape(shape)  # no data copying
+
+
+def initialize_worker(input_buffer, input_shape, input_dtype, output_buffer, output_shape, output_dtype, process_frames):
+    count = int(numpy.prod(input_shape))
+    worker_state["input"] = numpy.frombuffer(input_buffer, dtype=input_dtype, count=count).reshape(input_shape)
+    count = int(numpy.prod(output_shape))
+    worker_state["output"] = numpy.frombuffer(output_buffer, dtype=output_dtype, count=count).reshape(output_shape)
+    worker_state["process_frames"] = process_frames
+
+
+def process_chunk(chunk):
+    start, stop = chunk
+    worker_state["process_frames"](worker_state["input"][start:stop], worker_state["output"][start:stop])
+    return stop - start
+
+
+def chunks(start, stop, chunk_size):
+    return [(i, min(i + chunk_size, stop)) for i in range(start, stop, chunk_size)]
+
+
+def process_stack(data, process_frames, workers=WORKERS, chunk_size=None, progress=None, local_process_frames=None):
+    """
+        Apply process_frames(frames, out) to the frames (first axis) of the 3-D array data and
+        return the stack of results.
+
+        The first frame is done here to find the shape and dtype of a result; the output stack
+        is then allocated (in shared memory when a pool is used) and process_frames writes into
+        slices of it. chunk_size is the number of frames sent to a worker at a time. progress,
+        if given, is called with the number of frames done and the number of frames after each
+        chunk. local_process_frames, if given, is used instead of process_frames for the frames
+        done in this process; it need not be picklable.
+    """
+    frame_count = data.shape[0]
+    if frame_count == 0:
+        raise ValueError("empty stack")
+    first = numpy.empty((1, ) + data.shape[1:], dtype=data.dtype)
+    first[0] = data[0]
+    local_process_frames = local_process_frames or process_frames
+    first_out = process_frames_to_array(local_process_frames, first)
+    out_shape = (frame_count, ) + first_out.shape[1:]
+    workers = workers or multiprocessing.cpu_count()
+    use_pool = workers > 1 and frame_count > 2 and data.size >= POOL_MINIMUM_PIXELS and not in_worker()
+    if use_pool:
+        output_buffer, out = shared_array(out_shape, first_out.dtype)
+    else:
+        out = numpy.empty(out_shape, dtype=first_out.dtype)
+    out[0] = first_out[0]
+    if progress:
+        progress(1, frame_count)
+    if chunk_size is None:
+        chunk_size = max(1, -(-(frame_count - 1) // (max(workers, 1) * CHUNKS_PER_WORKER)))
+    frames_done = 1
+    if not use_pool:
+        for start, stop in chunks(1, frame_count, chunk_size):
+            local_process_frames(data[start:stop], out[start:stop])
+            frames_done += stop - start
+            if progress:
+                progress(frames_done, frame_count)
+        return out
+    input_buffer, shared_input = shared_array(data.shape, data.dtype)
+    shared_input[...] = data
+    pool = multiprocessing.Pool(min(workers, frame_count - 1), initialize_worker,
+                                (input_buffer, data.shape, data.dtype, output_buffer, out_shape, out.dtype,
+                                 process_frames))
+    try:
+        for count in pool.imap_unordered(process_chunk, chunks(1, frame_count, chunk_size)):
+            frames_done += count
+            if progress:
+                progress(frames_done, frame_count)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return out  # a view of the shared output buffer, which it keeps alive
+
+
+# process_frames into a new array, for the first frame, before the shape of a result is known.
+# process_frames writes into the out it is given, so give it a list and stack what it writes.
+def process_frames_to_array(process_frames, frames):
+    results = [None] * len(frames)
+    process_frames(frames, results)
+    return numpy.asarray(results)
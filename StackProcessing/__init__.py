@@ -0,0 +1,3 @@
+# Processing of 3-D stacks on a pool of worker processes, for the other plug-ins; see StackProcessor.py.
+
+import StackProcessor
@@ -1,80 +1,352 @@
 # standard libraries
 import functools
 import gettext
+import math
+import os
+import tempfile
 import threading
 import time
 
 # third party libraries
-# None
+import numpy
 
 # local libraries
-from nion.swift import Application
+from nion.swift import DataItem
 from nion.swift import HardwareSource
 
 
 _ = gettext.gettext
 
 
-# This section sets up the menu item to run a time lapse sequence.
-def build_menus(document_controller):
-    if not hasattr(document_controller, "script_menu"):
-        document_window = document_controller.document_window
-        document_controller.script_menu = document_window.insert_menu(_("Scripts"), document_controller.window_menu)
-    document_controller.script_menu.add_menu_item(_("Run Time Lapse"), lambda: run_time_lapse(document_controller),
-                                                  key_sequence="Ctrl+T")
+# Default time lapse settings. run_time_lapse takes these as keyword arguments.
+FRAME_COUNT = 5
+INTERVAL = 1.0  # seconds between the starts of frames
+LATE_POLICY = "skip"
+SINK = "stack"  # "stack" streams frames to one memory-mapped stack; "data_items" makes a data item per frame
+REFRESH_INTERVAL = 2.0  # seconds between updates of the stack data item while acquiring
+HANDOFF_CAPACITY = 16  # frames waiting for the UI thread, at most
+HANDOFF_POLICY = "block"  # what to do with a new frame when the UI thread is that far behind
 
+# A clock that never goes backwards, where available.
+monotonic = getattr(time, "monotonic", time.time)
 
-Application.app.register_menu_handler(build_menus)
+
+class TimeLapseSchedule(object):
+    """
+        Frame times for a time lapse, as absolute deadlines from the start, so that time spent
+        acquiring and queueing doesn't add up over a long run.
+
+        The number of frames is frame_count, or as many as fit in duration seconds if that is
+        given (the smaller of the two if both are). When a frame is late by a whole interval or
+        more, the "skip" policy drops the frames whose time has passed, and "catch_up" acquires
+        them back to back until it is on schedule again.
+    """
+
+    def __init__(self, frame_count=FRAME_COUNT, interval=INTERVAL, duration=None, late_policy=LATE_POLICY):
+        assert late_policy in ("skip", "catch_up")
+        if duration is not None:
+            duration_count = int(duration / interval) + 1 if interval > 0 else 1
+            frame_count = min(frame_count, duration_count) if frame_count is not None else duration_count
+        self.frame_count = frame_count
+        self.interval = interval
+        self.late_policy = late_policy
+        self.skipped_count = 0
+        self.start_time = None
+
+    # generates (index, scheduled time) for each frame, waiting until it is due. times are seconds
+    # from the start.
+    def frames(self, clock=monotonic, sleep=time.sleep):
+        self.start_time = clock()
+        index = 0
+        while index < self.frame_count:
+            scheduled_time = index * self.interval
+            late = clock() - self.start_time - scheduled_time
+            if late < 0:
+                sleep(-late)
+            elif self.late_policy == "skip" and late >= self.interval > 0:
+                skipped = min(int(late / self.interval), self.frame_count - index)
+                self.skipped_count += skipped
+                index += skipped
+                continue
+            yield index, scheduled_time
+            index += 1
+
+    def elapsed(self, clock=monotonic):
+        return clock() - self.start_time
+
+
+# Summary statistics of how late frames were, in seconds.
+def jitter_statistics(jitters):
+    if not jitters:
+        return {"mean": 0.0, "max": 0.0, "std": 0.0}
+    mean = sum(jitters) / len(jitters)
+    variance = sum((jitter - mean) ** 2 for jitter in jitters) / len(jitters)
+    return {"mean": mean, "max": max(jitters, key=abs), "std": math.sqrt(variance)}
+
+
+# Appending a data item to a group needs to happen on the UI thread.
+# This function will be placed in the document controllers UI thread queue.
+def append_data_item(_document_model, _data_group, _data_item):
+    assert threading.current_thread().getName() == "MainThread"
+    _document_model.append_data_item(_data_item)
+    _data_group.append_data_item(_data_item)
+
+
+class MainThreadHandoff(object):
+    """
+        Passes items from a worker thread to the UI thread in batches.
+
+        push adds an item to a bounded queue and, unless one is already waiting, queues a single
+        task to the UI thread, which hands everything pending to handler at once. So however far
+        behind the UI thread gets, there is at most one task waiting, and at most capacity items.
+
+        When the queue is full, the policy decides: "block" waits for the UI thread to catch up,
+        "drop" drops the new item, and "thin" drops every other waiting item (oldest first) to make
+        room, keeping the frames spread out over time.
+    """
+
+    def __init__(self, document_controller, handler, capacity=HANDOFF_CAPACITY, policy=HANDOFF_POLICY):
+        assert policy in ("block", "drop", "thin")
+        self.document_controller = document_controller
+        self.handler = handler
+        self.capacity = max(capacity, 1)
+        self.policy = policy
+        self.__items = list()  # (item, time pushed)
+        self.__condition = threading.Condition()
+        self.__drain_queued = False
+        self.pushed_count = 0
+        self.dropped_count = 0
+        self.thinned_count = 0
+        self.drain_count = 0
+        self.max_depth = 0
+        self.blocked_time = 0.0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        self.delivered_count = 0
+
+    @property
+    def depth(self):
+        with self.__condition:
+            return len(self.__items)
+
+    def push(self, item):
+        with self.__condition:
+            self.pushed_count += 1
+            if len(self.__items) >= self.capacity:
+                if self.policy == "drop":
+                    self.dropped_count += 1
+                    return
+                elif self.policy == "thin":
+                    kept = self.__items[1::2]
+                    self.thinned_count += len(self.__items) - len(kept)
+                    self.__items = kept
+                else:
+                    start_time = monotonic()
+                    while len(self.__items) >= self.capacity:
+                        self.__condition.wait()
+                    self.blocked_time += monotonic() - start_time
+            self.__items.append((item, monotonic()))
+            self.max_depth = max(self.max_depth, len(self.__items))
+            queue_drain = not self.__drain_queued
+            self.__drain_queued = True
+        if queue_drain:
+            self.document_controller.queue_main_thread_task(self.__drain)
+
+    def __drain(self):
+        with self.__condition:
+            items = self.__items
+            self.__items = list()
+            self.__drain_queued = False
+            now = monotonic()
+            for item, push_time in items:
+                self.total_latency += now - push_time
+                self.max_latency = max(self.max_latency, now - push_time)
+            self.delivered_count += len(items)
+            self.drain_count += 1
+            self.__condition.notify_all()
+        if items:
+            self.handler([item for item, push_time in items])
+
+    def metrics(self):
+        with self.__condition:
+            return {
+                "depth": len(self.__items),
+                "max_depth": self.max_depth,
+                "pushed": self.pushed_count,
+                "delivered": self.delivered_count,
+                "dropped": self.dropped_count,
+                "thinned": self.thinned_count,
+                "drains": self.drain_count,
+                "blocked_time": self.blocked_time,
+                "mean_latency": self.total_latency / self.delivered_count if self.delivered_count else 0.0,
+                "max_latency": self.max_latency,
+            }
+
+
+class DataItemSink(object):
+    """Adds each frame's data item to the document and the data group, handing them to the UI thread in batches."""
+
+    def __init__(self, document_controller, data_group, handoff_capacity=HANDOFF_CAPACITY, handoff_policy=HANDOFF_POLICY):
+        self.document_controller = document_controller
+        self.data_group = data_group
+        self.handoff = MainThreadHandoff(document_controller, self.__append_data_items, handoff_capacity, handoff_policy)
+
+    def __append_data_items(self, data_items):
+        for data_item in data_items:
+            append_data_item(self.document_controller.document_model, self.data_group, data_item)
+
+    def add(self, data_item):
+        self.handoff.push(data_item)
+
+    def finish(self):
+        pass
+
+    # rows for the end of the task results table, as (label, value).
+    def summary(self):
+        metrics = self.handoff.metrics()
+        return [(_("Max queue depth"), str(metrics["max_depth"])),
+                (_("Mean UI latency (ms)"), "{:.1f}".format(metrics["mean_latency"] * 1000)),
+                (_("Max UI latency (ms)"), "{:.1f}".format(metrics["max_latency"] * 1000)),
+                (_("Dropped by queue"), str(metrics["dropped"] + metrics["thinned"]))]
+
+
+class StackSink(object):
+    """
+        Writes each frame's data into a 3d stack in a memory-mapped .npy file at path,
+        preallocated for frame_count frames when the first frame arrives. The frames are written
+        on the acquisition thread, and memory use doesn't grow with the number of frames.
+
+        The document gets a single data item showing the frames so far (a view on the file, not a
+        copy). It is refreshed from the UI thread at most every refresh_interval seconds, and
+        once more at the end.
+    """
+
+    def __init__(self, document_controller, data_group, path, frame_count, refresh_interval=REFRESH_INTERVAL):
+        self.document_controller = document_controller
+        self.data_group = data_group
+        self.path = path
+        self.frame_count = frame_count
+        self.refresh_interval = refresh_interval
+        self.stack = None
+        self.count = 0
+        self.__data_item = None
+        self.__last_refresh_time = None
+        self.__refresh_pending = threading.Event()
+
+    def add(self, data_item):
+        data = data_item.data
+        if self.stack is None:
+            self.stack = numpy.lib.format.open_memmap(self.path, mode="w+", dtype=data.dtype,
+                                                      shape=(self.frame_count,) + data.shape)
+        self.stack[self.count] = data
+        self.count += 1
+        if self.__last_refresh_time is None or monotonic() - self.__last_refresh_time >= self.refresh_interval:
+            self.refresh()
+
+    # queue an update of the data item, unless one is still waiting to run.
+    def refresh(self):
+        if self.stack is None or self.__refresh_pending.is_set():
+            return
+        self.__last_refresh_time = monotonic()
+        self.__refresh_pending.set()
+        self.document_controller.queue_main_thread_task(functools.partial(self.__update_data_item, self.count))
+
+    def __update_data_item(self, count):
+        assert threading.current_thread().getName() == "MainThread"
+        self.__refresh_pending.clear()
+        data = self.stack[:count]
+        if self.__data_item is None:
+            self.__data_item = DataItem.DataItem(data)
+            self.__data_item.title = os.path.basename(self.path)
+            append_data_item(self.document_controller.document_model, self.data_group, self.__data_item)
+        else:
+            with self.__data_item.data_ref() as data_ref:
+                data_ref.master_data = data
+
+    def finish(self):
+        if self.stack is not None:
+            self.stack.flush()
+            self.__refresh_pending.clear()  # always show the final frame count
+            self.refresh()
+
+    def summary(self):
+        return [(_("Stack file"), self.path)]
 
 
 # This function will run on a thread. Consequently, it cannot modify the document model directly.
-# Instead, when it needs to add data items to the containing data group, it will queue that operation
-# to the main UI thread.
-def perform_time_lapse(document_controller, data_group):
+# Instead, the sink queues any changes to the document to the main UI thread.
+def perform_time_lapse(document_controller, schedule, sink):
+    frame_count = schedule.frame_count
+
     with document_controller.create_task_context_manager(_("Time Lapse"), "table") as task:
 
-        task.update_progress(_("Starting time lapse."), (0, 5))
+        task.update_progress(_("Starting time lapse."), (0, frame_count))
 
         # Get a data item generator for the hardware source 'video_capture'.
         # data_item_generator will be a function, which, when called, will return a data item from the camera.
         with HardwareSource.get_data_item_generator_by_id("video_capture") as data_item_generator:
 
-            task_data = {"headers": ["Number", "Time"]}
+            task_data = {"headers": ["Number", "Time", "Scheduled (s)", "Actual (s)", "Jitter (ms)"]}
+            jitters = list()
+
+            for i, scheduled_time in schedule.frames():
 
-            for i in xrange(5):
+                actual_time = schedule.elapsed()
+                jitters.append(actual_time - scheduled_time)
 
                 # update task results table. data should be in the form of
                 # { "headers": ["Header1", "Header2"],
                 #   "data": [["Data1A", "Data2A"], ["Data1B", "Data2B"], ["Data1C", "Data2C"]] }
                 data = task_data.setdefault("data", list())
-                task_data_entry = [str(i), time.strftime("%c", time.localtime())]
+                task_data_entry = [str(i), time.strftime("%c", time.localtime()), "{:.3f}".format(scheduled_time),
+                                   "{:.3f}".format(actual_time), "{:.1f}".format(jitters[-1] * 1000)]
                 data.append(task_data_entry)
-                task.update_progress(_("Acquiring time lapse item {}.").format(i), (i + 1, 5), task_data)
+                task.update_progress(_("Acquiring time lapse item {}.").format(i), (i + 1, frame_count), task_data)
 
                 # Grab the next data item.
                 data_item = data_item_generator()
                 if data_item is None:
                     break
 
-                # Appending a data item to a group needs to happen on the UI thread.
-                # This function will be placed in the document controllers UI thread queue.
-                def append_data_item(_document_model, _data_group, _data_item):
-                    assert threading.current_thread().getName() == "MainThread"
-                    _document_model.append_data_item(_data_item)
-                    _data_group.append_data_item(_data_item)
+                sink.add(data_item)
 
-                document_controller.queue_main_thread_task(
-                    functools.partial(append_data_item, document_controller.document_model, data_group, data_item))
+            sink.finish()
 
-                # Go to sleep and wait for the next frame.
-                time.sleep(1.0)
+            # Add the timing summary to the end of the table.
+            statistics = jitter_statistics(jitters)
+            data = task_data.setdefault("data", list())
+            data.append([_("Mean jitter"), "", "", "", "{:.1f}".format(statistics["mean"] * 1000)])
+            data.append([_("Max jitter"), "", "", "", "{:.1f}".format(statistics["max"] * 1000)])
+            data.append([_("Jitter std. dev."), "", "", "", "{:.1f}".format(statistics["std"] * 1000)])
+            data.append([_("Skipped"), "", "", "", str(schedule.skipped_count)])
+            for label, value in sink.summary():
+                data.append([label, "", "", "", value])
 
-        task.update_progress(_("Finishing time lapse."), (5, 5))
+        task.update_progress(_("Finishing time lapse."), (frame_count, frame_count), task_data)
 
         time.sleep(1.0)  # only here as a demonstration
 
 
+# Create an empty, new .npy file for a stack in directory (the temporary directory if None) and
+# return its path. Every run gets its own file, even runs started in the same second, since a data
+# item from an earlier run may still be showing the file it wrote.
+def create_stack_file(directory=None):
+    prefix = "Time Lapse {}-".format(time.strftime("%Y%m%d-%H%M%S"))
+    fd, path = tempfile.mkstemp(suffix=".npy", prefix=prefix, dir=directory)
+    os.close(fd)
+    return path
+
+
 # This is the main function that gets run when the user selects the menu item.
-def run_time_lapse(document_controller):
+# The stack file for the "stack" sink goes in stack_directory (the temporary directory by default).
+def run_time_lapse(document_controller, frame_count=FRAME_COUNT, interval=INTERVAL, duration=None,
+                   late_policy=LATE_POLICY, sink=SINK, stack_directory=None, handoff_capacity=HANDOFF_CAPACITY,
+                   handoff_policy=HANDOFF_POLICY):
+    schedule = TimeLapseSchedule(frame_count, interval, duration, late_policy)
     data_group = document_controller.document_model.get_or_create_data_group(_("Time Lapse"))
-    threading.Thread(target=perform_time_lapse, args=(document_controller, data_group)).start()
+    if sink == "stack":
+        path = create_stack_file(stack_directory)
+        sink = StackSink(document_controller, data_group, path, schedule.frame_count)
+    else:
+        sink = DataItemSink(document_controller, data_group, handoff_capacity, handoff_policy)
+    threading.Thread(target=perform_time_lapse, args=(document_controller, schedule, sink)).start()
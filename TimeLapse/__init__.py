@@ -1 +1,24 @@
-import TimeLapse
+# Adds the menu item here; TimeLapse is imported the first time a time lapse is run.
+
+import gettext
+
+from nion.swift import Application
+
+_ = gettext.gettext
+
+
+def run_time_lapse(document_controller):
+    import TimeLapse
+    TimeLapse.run_time_lapse(document_controller)
+
+
+# This section sets up the menu item to run a time lapse sequence.
+def build_menus(document_controller):
+    if not hasattr(document_controller, "script_menu"):
+        document_window = document_controller.document_window
+        document_controller.script_menu = document_window.insert_menu(_("Scripts"), document_controller.window_menu)
+    document_controller.script_menu.add_menu_item(_("Run Time Lapse"), lambda: run_time_lapse(document_controller),
+                                                  key_sequence="Ctrl+T")
+
+
+Application.app.register_menu_handler(build_menus)
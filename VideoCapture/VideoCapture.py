@@ -1,6 +1,8 @@
 # standard libraries
+import ctypes
 import gettext
 import logging
+import multiprocessing
 import numpy
 import threading
 import time
@@ -16,27 +18,44 @@ from nion.swift import HardwareSource
 _ = gettext.gettext
 
 
-# does not currently work. to switch to this, copy the hardware source code out of
-# simulator mp and enable this. add necessary imports too.
-def video_capture_process(buffer, cancel_event, ready_event, done_event):
-    logging.debug("video capture process start")
-    video_capture = cv2.VideoCapture(0)
-    logging.debug("video capture: %s", video_capture)
-    #video_capture.open(0)
-    logging.debug("video capture open")
-    while not cancel_event.is_set():
-        retval, image = video_capture.read()
-        logging.debug("video capture read %s", retval)
-        if retval:
-            logging.debug("video capture image %s", image.shape)
-            with buffer.get_lock(): # synchronize access
-                buffer_array = numpy.frombuffer(buffer.get_obj(), dtype=numpy.uint8) # no data copying
-                buffer_array.reshape(image.shape)[:] = image
-            ready_event.set()
-            done_event.wait()
-            done_event.clear()
-        time.sleep(0.001)
-    video_capture.release()
+# open the default camera. module level so that a capture process can use it.
+def open_camera():
+    return cv2.VideoCapture(0)
+
+
+class SyntheticVideoCapture(object):
+    """
+        Stands in for cv2.VideoCapture when there is no camera, e.g. for testing. Produces frames
+        of a diagonal ramp that moves by one level per frame, taking read_time seconds per read.
+    """
+
+    def __init__(self, width=640, height=480, read_time=0.0):
+        self.width = width
+        self.height = height
+        self.read_time = read_time
+        self.frame_index = 0
+        ramp = numpy.arange(height)[:, numpy.newaxis] + numpy.arange(width)[numpy.newaxis, :]
+        self.__ramp = numpy.repeat((ramp % 256).astype(numpy.uint8)[:, :, numpy.newaxis], 3, axis=2)
+
+    def get(self, property_id):
+        if property_id == cv.CV_CAP_PROP_FRAME_WIDTH:
+            return float(self.width)
+        if property_id == cv.CV_CAP_PROP_FRAME_HEIGHT:
+            return float(self.height)
+        return 0.0
+
+    def read(self, image=None):
+        if self.read_time > 0:
+            time.sleep(self.read_time)
+        if image is None or image.shape != self.__ramp.shape or image.dtype != numpy.uint8:
+            image = numpy.empty_like(self.__ramp)
+        self.frame_index += 1
+        numpy.add(self.__ramp, numpy.uint8(self.frame_index % 256), out=image)  # wraps around at 256
+        return True, image
+
+    def release(self):
+        pass
+
 
 # informal measurements show read() takes approx 70ms (14fps)
 # on Macbook Pro. CEM 2013-July.
@@ -45,22 +64,269 @@ def video_capture_process(buffer, cancel_event, ready_event, done_event):
 # limiting frame rate to 15fps). this means that the next frame
 # is constantly ready, so doesn't have to wait for it.
 # the hardware manager will happily eat up 100% of python-cpu time.
-MAX_FRAME_RATE = 20  # frames per second
-MINIMUM_DUTY = 0.05  # seconds
+# so FramePacer measures how long read() takes and starts reads later
+# when they had to wait for the camera, and keeps the capture loop
+# within a CPU duty budget.
+TARGET_FRAME_RATE = 20  # frames per second, by default
+DUTY_BUDGET = 0.5  # most of the time the capture loop may be busy, by default
+MINIMUM_IDLE = 0.001  # seconds; always give other threads a chance
+READ_WAIT_GAIN = 0.5  # how much of the time a read waited for the camera to add to the next delay
 TIMEOUT = 5.0  # seconds
+PROCESS_CHECK_INTERVAL = 0.5  # seconds without a frame after which the relay checks the capture process is alive
+
+
+class FramePacer(object):
+    """
+        Decides how long the capture loop waits after each frame.
+
+        The delay aims for target_frame_rate, but no faster than the consumer can take frames
+        (consumer_turnaround is a function returning how long the consumer spends with each
+        frame, not counting time waiting for the next one, or 0). A read that takes longer than
+        the fastest recent reads was waiting for the camera, so part of that wait is added to
+        the delay to start the next read when the frame is ready. The delay is never less than
+        what keeps busy / (busy + idle) within duty_budget.
+    """
+
+    def __init__(self, target_frame_rate=TARGET_FRAME_RATE, duty_budget=DUTY_BUDGET, consumer_turnaround=None):
+        FramePacer.check(target_frame_rate, duty_budget)
+        self.target_frame_rate = target_frame_rate
+        self.duty_budget = duty_budget
+        self.consumer_turnaround = consumer_turnaround
+        self.ready_read_time = None  # how long a read takes when the frame is already waiting
+
+    @staticmethod
+    def check(target_frame_rate, duty_budget):
+        if not target_frame_rate > 0:
+            raise ValueError("target_frame_rate must be positive, not %r" % (target_frame_rate, ))
+        if not 0 < duty_budget <= 1:
+            raise ValueError("duty_budget must be more than 0 and at most 1, not %r" % (duty_budget, ))
+
+    def next_delay(self, read_time, busy_time):
+        # track the fastest reads, letting the estimate creep up so it follows changes in the camera.
+        if self.ready_read_time is None or read_time < self.ready_read_time:
+            self.ready_read_time = read_time
+        else:
+            self.ready_read_time += 0.01 * (read_time - self.ready_read_time)
+        period = 1.0 / self.target_frame_rate
+        if self.consumer_turnaround:
+            period = max(period, min(self.consumer_turnaround(), 1.0))  # no point capturing frames nobody takes
+        delay = period - busy_time
+        delay += READ_WAIT_GAIN * (read_time - self.ready_read_time)
+        duty_delay = busy_time * (1.0 - self.duty_budget) / self.duty_budget
+        return max(delay, duty_delay, MINIMUM_IDLE)
+
+
+class AcquisitionTelemetry(object):
+    """
+        Counters kept by the capture loop: frames, failed reads, read latency histogram, busy and
+        idle time, and the achieved frame interval.
+
+        The values live in one float64 array, which can be placed in shared memory (pass a
+        RawArray of SIZE doubles as storage) so that a capture process can report to this one.
+        There is a single writer; readers may see a frame's updates half done.
+    """
+
+    READ_LATENCY_BINS = (0.002, 0.004, 0.008, 0.016, 0.032, 0.064, 0.128)  # upper edges in seconds; one more bin above
+    FRAMES, FAILED_READS, READ_TIME, BUSY_TIME, IDLE_TIME, FRAME_INTERVAL, LAST_FRAME_TIME, HISTOGRAM = range(8)
+    SIZE = HISTOGRAM + len(READ_LATENCY_BINS) + 1
+
+    def __init__(self, storage=None):
+        if storage is not None:
+            self.values = numpy.frombuffer(storage, dtype=numpy.float64)  # no data copying
+        else:
+            self.values = numpy.zeros(self.SIZE)
+
+    def record_read(self, read_time, success):
+        values = self.values
+        if not success:
+            values[self.FAILED_READS] += 1
+            return
+        values[self.READ_TIME] += read_time
+        bin_index = 0
+        while bin_index < len(self.READ_LATENCY_BINS) and read_time > self.READ_LATENCY_BINS[bin_index]:
+            bin_index += 1
+        values[self.HISTOGRAM + bin_index] += 1
+
+    def record_frame(self, now, busy_time, idle_time):
+        values = self.values
+        if values[self.FRAMES] > 0:
+            interval = now - values[self.LAST_FRAME_TIME]
+            if values[self.FRAME_INTERVAL] > 0:
+                values[self.FRAME_INTERVAL] += 0.1 * (interval - values[self.FRAME_INTERVAL])
+            else:
+                values[self.FRAME_INTERVAL] = interval
+        values[self.LAST_FRAME_TIME] = now
+        values[self.FRAMES] += 1
+        values[self.BUSY_TIME] += busy_time
+        values[self.IDLE_TIME] += idle_time
+
+    def snapshot(self):
+        values = self.values.copy()
+        frames = values[self.FRAMES]
+        busy_and_idle = values[self.BUSY_TIME] + values[self.IDLE_TIME]
+        histogram = values[self.HISTOGRAM:].astype(int).tolist()
+        return {
+            "frames": int(frames),
+            "failed_reads": int(values[self.FAILED_READS]),
+            "achieved_frame_rate": 1.0 / values[self.FRAME_INTERVAL] if values[self.FRAME_INTERVAL] > 0 else 0.0,
+            "mean_read_latency": values[self.READ_TIME] / frames if frames else 0.0,
+            "read_latency_histogram": list(zip(list(self.READ_LATENCY_BINS) + [float("inf")], histogram)),
+            "busy_time": values[self.BUSY_TIME],
+            "idle_time": values[self.IDLE_TIME],
+            "duty": values[self.BUSY_TIME] / busy_and_idle if busy_and_idle > 0 else 0.0,
+        }
+
+class Frame(object):
+    """A frame borrowed from a FrameRing. data is only valid until the frame is released."""
+
+    def __init__(self, slot, sequence, data):
+        self.slot = slot
+        self.sequence = sequence
+        self.data = data
+
+
+class FrameRing(object):
+    """
+        A ring of preallocated frame buffers shared by a capture thread and a consumer.
+
+        The capture thread never waits for the consumer: it asks for a slot to write with
+        begin_write, fills it, and publishes it with end_write. Each published frame gets the next
+        sequence number. The lock only guards the bookkeeping, never the copying of frame data.
+
+        With the "latest" policy the consumer always gets the newest frame, and unread older
+        frames are overwritten when the ring is full. With the "every" policy the consumer gets
+        frames in order, and new frames are dropped while the ring is full.
+
+        Consumers borrow a frame, use its data in place, and release it. A borrowed slot is
+        never written to. detach takes a borrowed frame's buffer for keeps, replacing it in the
+        ring with a new buffer, so a frame can be handed on without copying.
+    """
+
+    FREE, WRITING, READY, BORROWED = range(4)
+
+    def __init__(self, shape, dtype, size=4, policy="latest"):
+        assert size >= 2
+        assert policy in ("latest", "every")
+        self.policy = policy
+        self.__buffers = [numpy.empty(shape, dtype=dtype) for i in range(size)]
+        self.__states = [FrameRing.FREE] * size
+        self.__sequences = [0] * size
+        self.__sequence = 0
+        self.__closed = False
+        self.__condition = threading.Condition()
+        self.captured_count = 0  # frames published by the capture thread
+        self.delivered_count = 0  # frames borrowed by the consumer
+        self.dropped_count = 0  # frames captured that never reached the consumer
+        self.overrun_count = 0  # times the capture thread found no free slot
+        # smoothed time from the consumer giving a frame back to asking for the next one. time
+        # spent waiting in borrow isn't counted, so a consumer that keeps up doesn't slow capture.
+        self.consumer_turnaround = 0.0
+        self.__last_release_time = None
 
-def video_capture_thread(video_capture, buffer, cancel_event, ready_event, done_event):
+    def __oldest_ready(self):
+        ready = [slot for slot, state in enumerate(self.__states) if state == FrameRing.READY]
+        return min(ready, key=lambda slot: self.__sequences[slot]) if ready else None
+
+    # returns (slot, buffer) for the capture thread to fill, or None if the frame should be dropped.
+    def begin_write(self):
+        with self.__condition:
+            if FrameRing.FREE in self.__states:
+                slot = self.__states.index(FrameRing.FREE)
+            else:
+                # either the unread frame in the overwritten slot or the new frame is lost.
+                self.overrun_count += 1
+                self.dropped_count += 1
+                slot = self.__oldest_ready() if self.policy == "latest" else None
+                if slot is None:  # every slot is busy or the policy doesn't allow overwriting
+                    return None
+            self.__states[slot] = FrameRing.WRITING
+            return slot, self.__buffers[slot]
+
+    def end_write(self, slot, success=True):
+        with self.__condition:
+            if success:
+                self.__sequence += 1
+                self.__sequences[slot] = self.__sequence
+                self.__states[slot] = FrameRing.READY
+                self.captured_count += 1
+                self.__condition.notify_all()
+            else:
+                self.__states[slot] = FrameRing.FREE
+
+    # waits for a frame and returns it, or returns None on timeout or when the ring is closed.
+    def borrow(self, timeout=None):
+        with self.__condition:
+            if self.__last_release_time is not None:
+                turnaround = time.time() - self.__last_release_time
+                self.consumer_turnaround = self.consumer_turnaround + 0.2 * (turnaround - self.consumer_turnaround) if self.consumer_turnaround else turnaround
+                self.__last_release_time = None
+            deadline = time.time() + timeout if timeout is not None else None
+            while not self.__closed and FrameRing.READY not in self.__states:
+                remaining = deadline - time.time() if deadline is not None else None
+                if remaining is not None and remaining <= 0:
+                    return None
+                self.__condition.wait(remaining)
+            if self.__closed:
+                return None
+            slot = self.__oldest_ready()
+            if self.policy == "latest":
+                ready = [slot for slot, state in enumerate(self.__states) if state == FrameRing.READY]
+                slot = max(ready, key=lambda slot: self.__sequences[slot])
+                for skipped_slot in ready:
+                    if skipped_slot != slot:
+                        self.__states[skipped_slot] = FrameRing.FREE
+                        self.dropped_count += 1
+            self.__states[slot] = FrameRing.BORROWED
+            self.delivered_count += 1
+            return Frame(slot, self.__sequences[slot], self.__buffers[slot])
+
+    # count frames that were lost before they got to the ring.
+    def note_dropped(self, count):
+        with self.__condition:
+            self.dropped_count += count
+
+    def release(self, frame):
+        with self.__condition:
+            self.__states[frame.slot] = FrameRing.FREE
+            self.__last_release_time = time.time()
+
+    # takes the buffer of a borrowed frame for keeps and releases the frame.
+    def detach(self, frame):
+        with self.__condition:
+            data = self.__buffers[frame.slot]
+            self.__buffers[frame.slot] = numpy.empty_like(data)
+            self.__states[frame.slot] = FrameRing.FREE
+            self.__last_release_time = time.time()
+            return data
+
+    # wakes up any waiting consumer; borrow returns None from now on.
+    def close(self):
+        with self.__condition:
+            self.__closed = True
+            self.__condition.notify_all()
+
+
+def video_capture_thread(video_capture, ring, cancel_event, pacer, telemetry):
 
     while not cancel_event.is_set():
         start = time.time()
-        retval, image = video_capture.read()
+        reservation = ring.begin_write()
+        if reservation is not None:
+            slot, buffer = reservation
+            retval, image = video_capture.read(buffer)  # reads straight into the slot when it can
+            read_time = time.time() - start
+            if retval and image is not buffer:
+                buffer[:] = image
+            ring.end_write(slot, retval)
+        else:
+            # the ring is full; keep the camera drained anyway.
+            retval, image = video_capture.read()
+            read_time = time.time() - start
+        telemetry.record_read(read_time, retval)
         if retval:
-            buffer[:] = image
-            ready_event.set()
-            done_event.wait()
-            done_event.clear()
-            elapsed = time.time() - start
-            delay = max(1.0/MAX_FRAME_RATE - elapsed, MINIMUM_DUTY)
+            busy_time = time.time() - start
+            delay = pacer.next_delay(read_time, busy_time)
+            telemetry.record_frame(time.time(), busy_time, delay)
             cancel_event.wait(delay)
         else:
             # we MUST give other threads a chance to process - so sleep here.
@@ -69,42 +335,217 @@ def video_capture_thread(video_capture, buffer, cancel_event, ready_event, done_
     video_capture.release()
 
 
+# runs in a separate process, so that reading the camera and converting colours don't compete
+# with the user interface for the GIL. frames are written into one of the shared memory buffers,
+# chosen so that it is the oldest one and not the one the parent is reading. sequences holds the
+# sequence number of the frame in each buffer (0 while it is being written).
+def video_capture_process(video_capture_factory, shape, buffers, sequences, reading, lock, frame_event, cancel_event,
+                          target_frame_rate, duty_budget, consumer_turnaround, telemetry_storage):
+    logging.debug("video capture process start")
+    video_capture = video_capture_factory()
+    frames = [numpy.frombuffer(buffer, dtype=numpy.uint8).reshape(shape) for buffer in buffers]  # no data copying
+    pacer = FramePacer(target_frame_rate, duty_budget, lambda: consumer_turnaround.value)
+    telemetry = AcquisitionTelemetry(telemetry_storage)
+    sequence = 0
+    while not cancel_event.is_set():
+        start = time.time()
+        with lock:
+            slot = min((slot for slot in range(len(frames)) if slot != reading.value), key=lambda slot: sequences[slot])
+            sequences[slot] = 0
+        retval, image = video_capture.read(frames[slot])
+        read_time = time.time() - start
+        telemetry.record_read(read_time, retval)
+        if retval:
+            if image is not frames[slot]:
+                frames[slot][:] = image
+            sequence += 1
+            with lock:
+                sequences[slot] = sequence
+            frame_event.set()
+            busy_time = time.time() - start
+            delay = pacer.next_delay(read_time, busy_time)
+            telemetry.record_frame(time.time(), busy_time, delay)
+            cancel_event.wait(delay)
+        else:
+            # we MUST give other processes a chance to process - so sleep here.
+            time.sleep(0.001)
+    video_capture.release()
+    logging.debug("video capture process end")
+
+
+class VideoCaptureProcess(object):
+    """
+        Runs video_capture_process in a separate process and copies each new frame it writes to
+        shared memory into a FrameRing, on a thread in this process. The capture process paces
+        itself like the capture thread does; the relay passes it the ring's consumer turnaround, and
+        it reports telemetry through shared memory.
+    """
+
+    BUFFER_COUNT = 3  # one being written, one being read, and the newest complete frame
+
+    def __init__(self, video_capture_factory, shape, ring, target_frame_rate=TARGET_FRAME_RATE, duty_budget=DUTY_BUDGET):
+        FramePacer.check(target_frame_rate, duty_budget)  # here, rather than in the capture process
+        self.__shape = shape
+        self.__ring = ring
+        size = int(numpy.prod(shape))
+        self.__buffers = [multiprocessing.RawArray(ctypes.c_uint8, size) for i in range(self.BUFFER_COUNT)]
+        self.__sequences = multiprocessing.RawArray(ctypes.c_ulong, self.BUFFER_COUNT)
+        self.__reading = multiprocessing.RawValue(ctypes.c_int, -1)
+        self.__lock = multiprocessing.Lock()
+        self.__frame_event = multiprocessing.Event()
+        self.__cancel_event = multiprocessing.Event()
+        self.__consumer_turnaround = multiprocessing.RawValue(ctypes.c_double, 0.0)
+        telemetry_storage = multiprocessing.RawArray(ctypes.c_double, AcquisitionTelemetry.SIZE)
+        self.telemetry = AcquisitionTelemetry(telemetry_storage)
+        self.__process = multiprocessing.Process(target=video_capture_process,
+                                                 args=(video_capture_factory, shape, self.__buffers, self.__sequences,
+                                                       self.__reading, self.__lock, self.__frame_event,
+                                                       self.__cancel_event, target_frame_rate, duty_budget,
+                                                       self.__consumer_turnaround, telemetry_storage))
+        self.__process.daemon = True  # never outlive the application
+        self.__thread = threading.Thread(target=self.__relay)
+
+    def start(self):
+        self.__process.start()
+        self.__thread.start()
+
+    def stop(self):
+        self.__cancel_event.set()
+        self.__frame_event.set()  # wake up the relay thread
+        self.__thread.join()
+        self.__process.join(TIMEOUT)
+        if self.__process.is_alive():
+            logging.warn("video capture process did not stop; terminating it")
+            self.__process.terminate()
+            self.__process.join()
+
+    def __relay(self):
+        frames = [numpy.frombuffer(buffer, dtype=numpy.uint8).reshape(self.__shape) for buffer in self.__buffers]
+        last_sequence = 0
+        while not self.__cancel_event.is_set():
+            if not self.__frame_event.wait(PROCESS_CHECK_INTERVAL):
+                if not self.__process.is_alive() and not self.__cancel_event.is_set():
+                    # e.g. the camera couldn't be opened or read raised; nothing more will come.
+                    logging.error("video capture process exited unexpectedly (exit code %s)", self.__process.exitcode)
+                    self.__ring.close()  # so that the consumer isn't left waiting
+                    return
+                continue
+            self.__frame_event.clear()
+            self.__consumer_turnaround.value = self.__ring.consumer_turnaround
+            with self.__lock:
+                slot = max(range(self.BUFFER_COUNT), key=lambda slot: self.__sequences[slot])
+                sequence = self.__sequences[slot]
+                if sequence > last_sequence:
+                    self.__reading.value = slot  # the capture process won't write here now
+            if sequence <= last_sequence:
+                continue
+            if sequence > last_sequence + 1:
+                self.__ring.note_dropped(sequence - last_sequence - 1)  # frames overwritten before we got to them
+            last_sequence = sequence
+            reservation = self.__ring.begin_write()
+            if reservation is not None:
+                ring_slot, buffer = reservation
+                buffer[:] = frames[slot]
+                self.__ring.end_write(ring_slot)
+            with self.__lock:
+                self.__reading.value = -1
+
+
 class VideoCaptureHardwareSource(HardwareSource.HardwareSource):
 
     def __init__(self):
         self.hardware_source_id = "video_capture"
         self.hardware_source = _("Video Capture")
         super(VideoCaptureHardwareSource, self).__init__(self.hardware_source_id, self.hardware_source)
+        # number of frame buffers and what to do when the consumer falls behind: "latest" skips
+        # to the newest frame, "every" keeps the queued frames and drops new ones.
+        self.frame_ring_size = 4
+        self.frame_policy = "latest"
+        # "thread" reads the camera on a thread in this process; "process" reads it in a separate
+        # process. can also be chosen per acquisition with a "backend" entry in mode_data.
+        self.backend = "thread"
+        # makes the object to read frames from, cv2.VideoCapture-like. must be picklable (e.g.
+        # module level) for the process backend on platforms that don't fork.
+        self.video_capture_factory = open_camera
+        # pacing of the capture loop; see FramePacer.
+        self.target_frame_rate = TARGET_FRAME_RATE
+        self.duty_budget = DUTY_BUDGET
+        self.ring = None
+        self.telemetry = None
+
+    @property
+    def dropped_frame_count(self):
+        return self.ring.dropped_count if self.ring else 0
+
+    @property
+    def overrun_count(self):
+        return self.ring.overrun_count if self.ring else 0
+
+    # a dict of acquisition statistics: see AcquisitionTelemetry.snapshot, plus the frame ring
+    # counters and the consumer's smoothed turnaround.
+    def get_telemetry(self):
+        telemetry = self.telemetry.snapshot() if self.telemetry else dict()
+        if self.ring:
+            telemetry.update({
+                "frames_captured": self.ring.captured_count,
+                "frames_delivered": self.ring.delivered_count,
+                "frames_dropped": self.ring.dropped_count,
+                "overruns": self.ring.overrun_count,
+                "consumer_turnaround": self.ring.consumer_turnaround,
+            })
+        return telemetry
 
     def start_acquisition(self, mode, mode_data):
-        video_capture = cv2.VideoCapture(0)
-        width = video_capture.get(cv.CV_CAP_PROP_FRAME_WIDTH)
-        height = video_capture.get(cv.CV_CAP_PROP_FRAME_HEIGHT)
-        self.buffer = numpy.empty((height, width, 3), dtype=numpy.uint8)
-        self.cancel_event = threading.Event()
-        self.ready_event = threading.Event()
-        self.done_event = threading.Event()
-        self.thread = threading.Thread(target=video_capture_thread, args=(video_capture, self.buffer, self.cancel_event, self.ready_event, self.done_event))
-        self.thread.start()
+        FramePacer.check(self.target_frame_rate, self.duty_budget)  # before opening the camera
+        backend = mode_data.get("backend", self.backend) if isinstance(mode_data, dict) else self.backend
+        video_capture = self.video_capture_factory()
+        width = int(video_capture.get(cv.CV_CAP_PROP_FRAME_WIDTH))
+        height = int(video_capture.get(cv.CV_CAP_PROP_FRAME_HEIGHT))
+        self.ring = FrameRing((height, width, 3), numpy.uint8, self.frame_ring_size, self.frame_policy)
+        if backend == "process":
+            video_capture.release()  # the capture process opens its own
+            self.capture_process = VideoCaptureProcess(self.video_capture_factory, (height, width, 3), self.ring,
+                                                       self.target_frame_rate, self.duty_budget)
+            self.telemetry = self.capture_process.telemetry
+            self.capture_process.start()
+            self.thread = None
+        else:
+            self.capture_process = None
+            self.cancel_event = threading.Event()
+            self.telemetry = AcquisitionTelemetry()
+            ring = self.ring
+            pacer = FramePacer(self.target_frame_rate, self.duty_budget, lambda: ring.consumer_turnaround)
+            self.thread = threading.Thread(target=video_capture_thread,
+                                           args=(video_capture, self.ring, self.cancel_event, pacer, self.telemetry))
+            self.thread.start()
+
+    # borrow the next frame without copying it. the frame must be given back with release_frame.
+    def borrow_frame(self, timeout=None):
+        return self.ring.borrow(timeout)
+
+    def release_frame(self, frame):
+        self.ring.release(frame)
 
     def acquire_data_elements(self):
-        self.ready_event.wait()
-        self.ready_event.clear()
-        data = self.buffer.copy()
-        self.done_event.set()
+        frame = self.ring.borrow()
+        if frame is None:  # acquisition stopped
+            return list()
+        # the data item keeps the data, so take the buffer out of the ring instead of copying it.
+        data = self.ring.detach(frame)
         data_element = {
             "data": data,
             "properties": {
                 "hardware_source": self.hardware_source,
                 "hardware_source_id": self.hardware_source_id,
+                "frame_sequence": frame.sequence,
             }
         }
         return [data_element]
 
     def stop_acquisition(self):
-        self.cancel_event.set()
-        self.done_event.set()
-        self.thread.join()
-
-
-HardwareSource.HardwareSourceManager().register_hardware_source(VideoCaptureHardwareSource())
+        self.ring.close()
+        if self.capture_process:
+            self.capture_process.stop()
+        else:
+            self.cancel_event.set()
+            self.thread.join()
@@ -1,4 +1,5 @@
 import gettext
+import threading
 
 # third party libraries
 # see http://docs.opencv.org/index.html
@@ -9,7 +10,6 @@ import numpy
 # local libraries
 from nion.imaging import Image
 from nion.imaging import Operation
-from nion.swift import Application
 from nion.swift.Decorators import relative_file
 _ = gettext.gettext  # for translation
 
@@ -19,42 +19,112 @@ def draw_rects(img, rects, color):
         cv2.rectangle(img, (x1, y1), (x2, y2), color, 2)
 
 
-def detect(img, cascade_fn, scaleFactor=1.3, minNeighbors=4, minSize=(20, 20), flags=cv.CV_HAAR_SCALE_IMAGE):
+# cascades are slow to load (the xml is parsed), so keep one per file per thread; a classifier
+# shouldn't be shared between threads.
+cascades = threading.local()
 
-    cascade = cv2.CascadeClassifier(cascade_fn)
-    rects = cascade.detectMultiScale(img, scaleFactor=scaleFactor, minNeighbors=minNeighbors, minSize=minSize, flags=flags)
+
+def get_cascade(cascade_fn):
+    cache = cascades.__dict__.setdefault("cache", dict())
+    cascade = cache.get(cascade_fn)
+    if cascade is None:
+        cascade = cv2.CascadeClassifier(cascade_fn)
+        cache[cascade_fn] = cascade
+    return cascade
+
+
+def detect(img, cascade_fn, scaleFactor=1.3, minNeighbors=4, minSize=(20, 20), flags=cv.CV_HAAR_SCALE_IMAGE, maxSize=None):
+
+    cascade = get_cascade(cascade_fn)
+    if maxSize is not None:
+        rects = cascade.detectMultiScale(img, scaleFactor=scaleFactor, minNeighbors=minNeighbors, minSize=minSize, flags=flags, maxSize=maxSize)
+    else:
+        rects = cascade.detectMultiScale(img, scaleFactor=scaleFactor, minNeighbors=minNeighbors, minSize=minSize, flags=flags)
     if len(rects) == 0:
         return []
     rects[:, 2:] += rects[:, :2]
     return rects
 
 
+# detect on a copy of the gray image scaled by scale (< 1 to shrink it) and return the rectangles
+# in full resolution coordinates.
+def detect_scaled(img_gray, cascade_fn, scale=1.0, minSize=(20, 20)):
+    if scale != 1.0:
+        img_gray = cv2.resize(img_gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        minSize = (max(int(round(minSize[0] * scale)), 1), max(int(round(minSize[1] * scale)), 1))
+    img_gray = cv2.equalizeHist(img_gray)
+    rects = detect(img_gray, cascade_fn, minSize=minSize)
+    if len(rects) == 0:
+        return []
+    return numpy.round(rects / scale).astype(numpy.int32) if scale != 1.0 else rects
+
+
+# look for each of rects again, only in a region around where it was and only at about the same
+# size. returns the rectangles found, at most one per rectangle given.
+def track(img_gray, rects, cascade_fn, margin=0.5):
+    height, width = img_gray.shape[:2]
+    found = list()
+    for x1, y1, x2, y2 in rects:
+        w, h = x2 - x1, y2 - y1
+        left, top = max(int(x1 - margin * w), 0), max(int(y1 - margin * h), 0)
+        right, bottom = min(int(x2 + margin * w), width), min(int(y2 + margin * h), height)
+        roi = cv2.equalizeHist(numpy.ascontiguousarray(img_gray[top:bottom, left:right]))
+        roi_rects = detect(roi, cascade_fn, scaleFactor=1.1, minSize=(int(w * 0.7), int(h * 0.7)),
+                           maxSize=(int(w * 1.4), int(h * 1.4)))
+        if len(roi_rects) > 0:
+            # the one whose centre is closest to the old centre
+            centres = (roi_rects[:, :2] + roi_rects[:, 2:]) / 2.0 + (left, top)
+            distances = numpy.sum(numpy.square(centres - ((x1 + x2) / 2.0, (y1 + y2) / 2.0)), axis=1)
+            found.append(roi_rects[numpy.argmin(distances)] + (left, top, left, top))
+    return found
+
+
 class FaceDetectionOperation(Operation.Operation):
 
     def __init__(self):
         super(FaceDetectionOperation, self).__init__(_("Face Detection"), "face-detection-operation")
-
-    def process(self, data):
+        # detect on the frame scaled by this much (e.g. 0.5); the rectangles are drawn at full size.
+        self.detection_scale = 1.0
+        # for live video: only run the full detection every keyframe_interval frames, and in
+        # between look for the faces found last time near where they were. a face that can't be
+        # found again triggers a full detection right away.
+        self.tracking = False
+        self.keyframe_interval = 10
+        self.tracking_margin = 0.5  # how far around a face to look, as a fraction of its size
+        self.__tracked_rects = list()
+        self.__frames_since_keyframe = None  # None until the first full detection
+
+    # return a gray image to detect on and a color image to draw on. the color image is always a
+    # new array, so the input data isn't changed.
+    def prepare_images(self, data):
+        if data.dtype == numpy.uint8 and data.ndim == 3 and data.shape[2] == 3:
+            # bgr, e.g. straight from video capture
+            return cv2.cvtColor(data, cv.CV_BGR2GRAY), data.copy()
+        if data.dtype == numpy.uint8 and data.ndim == 2:
+            return data, cv2.cvtColor(data, cv.CV_GRAY2BGR)
         img = Image.create_rgba_image_from_array(data)  # inefficient since we're just converting back to gray
         if id(img) == id(data):
             img = img.copy()
         if id(img.base) == id(data):
             img = img.copy()
         img = img.view(numpy.uint8).reshape(img.shape + (4,))  # expand the color into uint8s
-        img_gray = cv2.cvtColor(img, cv.CV_RGB2GRAY)
-        img_gray = cv2.equalizeHist(img_gray)
-        rects = detect(img_gray, relative_file(__file__, "haarcascade_frontalface_alt.xml"))
+        return cv2.cvtColor(img, cv.CV_RGB2GRAY), img
+
+    def find_faces(self, img_gray):
+        cascade_fn = relative_file(__file__, "haarcascade_frontalface_alt.xml")
+        if self.tracking and self.__frames_since_keyframe is not None and self.__frames_since_keyframe < self.keyframe_interval:
+            rects = track(img_gray, self.__tracked_rects, cascade_fn, self.tracking_margin)
+            if len(rects) == len(self.__tracked_rects):
+                self.__tracked_rects = rects
+                self.__frames_since_keyframe += 1
+                return rects
+        rects = detect_scaled(img_gray, cascade_fn, self.detection_scale)
+        self.__tracked_rects = list(rects)
+        self.__frames_since_keyframe = 1
+        return rects
+
+    def process(self, data):
+        img_gray, img = self.prepare_images(data)
+        rects = self.find_faces(img_gray)
         draw_rects(img, rects, (0, 255, 0))
         return img
-
-
-def processing_face_detect(document_controller):
-    document_controller.add_processing_operation_by_id("face-detection-operation", prefix=_("Face Detection of "))
-
-
-def build_menus(document_controller):
-    document_controller.processing_menu.add_menu_item(_("Face Detection"), lambda: processing_face_detect(document_controller))
-
-Application.app.register_menu_handler(build_menus)
-
-Operation.OperationManager().register_operation("face-detection-operation", lambda: FaceDetectionOperation())
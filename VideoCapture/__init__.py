@@ -1,2 +1,77 @@
-import VideoCapture
-import VideoCaptureOperations
+# Registers the face detection operation, its menu item and the video capture hardware source
+# without importing cv2. VideoCaptureOperations is imported the first time the operation is made,
+# and VideoCapture the first time the hardware source is used.
+
+import gettext
+
+from nion.imaging import Operation
+from nion.swift import Application
+from nion.swift import HardwareSource
+
+try:
+    from Profiling import Profiler
+except ImportError:  # the Profiling plug-in isn't installed
+    Profiler = None
+
+_ = gettext.gettext  # for translation
+
+
+class VideoCaptureHardwareSourceProxy(HardwareSource.HardwareSource):
+    """
+        Stands in for a VideoCapture.VideoCaptureHardwareSource, which is made (and cv2 imported)
+        on first use. Reading an attribute the proxy doesn't have reads it from the hardware
+        source; settings are changed on get_hardware_source(), e.g.
+        proxy.get_hardware_source().backend = "process".
+    """
+
+    def __init__(self):
+        super(VideoCaptureHardwareSourceProxy, self).__init__("video_capture", _("Video Capture"))
+        self.__hardware_source = None
+
+    def get_hardware_source(self):
+        if self.__hardware_source is None:
+            import VideoCapture
+            self.__hardware_source = VideoCapture.VideoCaptureHardwareSource()
+            if Profiler:
+                # time the wait for each frame, with the frame's shape and the frames dropped so far
+                Profiler.instrument(self.__hardware_source, "acquire_data_elements", "video_capture",
+                                    ("backend", "frame_policy", "target_frame_rate", "dropped_frame_count"),
+                                    lambda args, result: result[0]["data"] if result else None)
+        return self.__hardware_source
+
+    def start_acquisition(self, mode, mode_data):
+        return self.get_hardware_source().start_acquisition(mode, mode_data)
+
+    def acquire_data_elements(self):
+        return self.get_hardware_source().acquire_data_elements()
+
+    def stop_acquisition(self):
+        return self.get_hardware_source().stop_acquisition()
+
+    def __getattr__(self, name):
+        # only called for attributes the proxy doesn't have itself
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self.get_hardware_source(), name)
+
+
+def create_face_detection_operation():
+    import VideoCaptureOperations
+    operation = VideoCaptureOperations.FaceDetectionOperation()
+    if Profiler:
+        Profiler.instrument(operation, parameters=("detection_scale", "tracking", "keyframe_interval"))
+    return operation
+
+
+def processing_face_detect(document_controller):
+    document_controller.add_processing_operation_by_id("face-detection-operation", prefix=_("Face Detection of "))
+
+
+def build_menus(document_controller):
+    document_controller.processing_menu.add_menu_item(_("Face Detection"), lambda: processing_face_detect(document_controller))
+
+Application.app.register_menu_handler(build_menus)
+
+Operation.OperationManager().register_operation("face-detection-operation", create_face_detection_operation)
+
+HardwareSource.HardwareSourceManager().register_hardware_source(VideoCaptureHardwareSourceProxy())
@@ -0,0 +1,452 @@
+"""
+    Benchmarks for the processing operations and the video capture acquisition loop.
+
+    Runs outside of Swift: nion.imaging and nion.swift are replaced by the stand-ins the tests
+    use (tests/nion_stand_ins.py) before the plug-ins are imported, and the operations are made
+    through the factories the plug-ins register, just as Swift would make them. Each operation's process is timed on synthetic real
+    and complex frames over a range of sizes and dtypes, and on 3-D stacks of them, and the report
+    gives latency percentiles, throughput and peak memory for each case. The peak memory of each
+    case is measured in a new Python process, so that what earlier cases used doesn't hide it, and
+    is shown as n/a when it can't be measured.
+
+    python benchmark_operations.py                                  # everything
+    python benchmark_operations.py -o double_gaussian_filter -s 512 1024
+    python benchmark_operations.py --save-baseline baseline.json    # remember these results
+    python benchmark_operations.py --baseline baseline.json         # flag cases that got slower
+
+    With --baseline the exit status is 1 when any case's median latency is more than --threshold
+    (as a fraction) slower than in the baseline. The face detection and video capture cases need
+    cv2 and are skipped without it.
+
+    This directory has no __init__.py, so Swift doesn't load it as a plug-in.
+"""
+
+# standard libraries
+import argparse
+import functools
+import gc
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+# third party libraries
+import numpy
+
+try:
+    import tracemalloc  # numpy reports its allocations to tracemalloc from numpy 1.13 on Python 3
+except ImportError:
+    tracemalloc = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+TESTS_DIRECTORY = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "tests")
+
+SIZES = (256, 512, 1024, 2048)
+REPEAT = 20
+WARMUP = 2
+THRESHOLD = 0.10  # a case is a regression when its median is this much slower than the baseline
+VIDEO_FRAMES = 100
+STACK_FRAMES = 32  # frames in the 3-D stack cases, which are only run for sizes up to STACK_MAXIMUM_SIZE
+STACK_MAXIMUM_SIZE = 1024
+VIDEO_SIZES = ((640, 480), (1280, 720), (1920, 1080))
+
+timer = getattr(time, "perf_counter", time.time)
+
+
+def has_cv2():
+    try:
+        import cv2
+    except ImportError:
+        return False
+    return True
+
+
+# Synthetic data: smooth structure plus noise, so that nothing is special-cased on constant
+# input, and a spot pattern in the complex frames like the FFT of a crystal lattice.
+
+def make_frame(shape, dtype, seed=0):
+    random = numpy.random.RandomState(seed)
+    dtype = numpy.dtype(dtype)
+    h, w = shape[:2]
+    y, x = numpy.ogrid[0:h, 0:w]
+    real = numpy.sin(x * 0.05) * numpy.cos(y * 0.07) + random.normal(0.0, 0.1, (h, w))
+    if dtype.kind == "c":
+        phase = random.uniform(-numpy.pi, numpy.pi, (h, w))
+        spots = numpy.exp(-((x - w // 2) % 32 - 16) ** 2 / 8.0 - ((y - h // 2) % 32 - 16) ** 2 / 8.0)
+        return ((spots + 0.01 * numpy.abs(real)) * numpy.exp(1j * phase)).astype(dtype)
+    if dtype.kind in "ui":
+        levels = numpy.iinfo(dtype).max if dtype.itemsize == 1 else 4095
+        data = (real - real.min()) / (real.max() - real.min()) * levels
+        if len(shape) == 3:
+            data = numpy.repeat(data[:, :, numpy.newaxis], shape[2], axis=2)
+        return data.astype(dtype)
+    return real.astype(dtype)
+
+
+class Case(object):
+    """
+        One benchmark: an operation made by the registered factory, configured by configure and
+        run on a frame of the given shape and dtype.
+    """
+
+    def __init__(self, operation_id, label, shape, dtype, configure=None):
+        self.operation_id = operation_id
+        self.label = label
+        self.shape = tuple(shape)
+        self.dtype = numpy.dtype(dtype)
+        self.configure = configure
+
+    @property
+    def name(self):
+        return "%s %s %s" % (self.label, self.dtype.name, "x".join(str(n) for n in self.shape))
+
+    @property
+    def is_stack(self):
+        return self.label.endswith("_stack")
+
+    @property
+    def pixels(self):
+        if self.is_stack:
+            return self.shape[0] * self.shape[1] * self.shape[2]
+        return self.shape[0] * self.shape[1]
+
+    def make_data(self):
+        if self.is_stack:
+            return numpy.array([make_frame(self.shape[1:], self.dtype, seed) for seed in range(self.shape[0])])
+        return make_frame(self.shape, self.dtype)
+
+    def create_operation(self):
+        from nion.imaging import Operation
+        operation = Operation.OperationManager().build_operation(self.operation_id)
+        if self.configure:
+            self.configure(operation)
+        return operation
+
+
+def set_attributes(**attributes):
+    def configure(operation):
+        for key, value in attributes.items():
+            setattr(operation, key, value)
+    return configure
+
+
+def build_cases(operations, sizes):
+    cases = list()
+    for size in sizes:
+        shape = (size, size)
+        if "double_gaussian_filter" in operations:
+            for dtype in (numpy.float32, numpy.float64, numpy.uint16):
+                cases.append(Case("double-gaussian-filter-operation", "double_gaussian_filter", shape, dtype))
+        if "circle_ifft" in operations:
+            for dtype in (numpy.complex64, numpy.complex128):
+                cases.append(Case("circle-ifft-operation", "circle_ifft", shape, dtype))
+            cases.append(Case("circle-ifft-operation", "circle_ifft_auto_single", shape, numpy.complex64,
+                              set_attributes(output_size="auto", single_precision=True)))
+        if "color_phase" in operations:
+            for dtype in (numpy.float32, numpy.complex64, numpy.complex128):
+                cases.append(Case("color-phase-operation", "color_phase", shape, dtype))
+        if "face_detection" in operations:
+            cases.append(Case("face-detection-operation", "face_detection", shape + (3,), numpy.uint8))
+            cases.append(Case("face-detection-operation", "face_detection", shape, numpy.float32))
+            cases.append(Case("face-detection-operation", "face_detection_half_scale", shape + (3,), numpy.uint8,
+                              set_attributes(detection_scale=0.5)))
+        if size <= STACK_MAXIMUM_SIZE:
+            stack_shape = (STACK_FRAMES, size, size)
+            if "double_gaussian_filter" in operations:
+                cases.append(Case("double-gaussian-filter-operation", "double_gaussian_filter_stack", stack_shape,
+                                  numpy.float32))
+            if "circle_ifft" in operations:
+                cases.append(Case("circle-ifft-operation", "circle_ifft_stack", stack_shape, numpy.complex64))
+            if "color_phase" in operations:
+                cases.append(Case("color-phase-operation", "color_phase_stack", stack_shape, numpy.complex64))
+    return cases
+
+
+def percentile(sorted_values, fraction):
+    return float(numpy.percentile(sorted_values, fraction * 100.0))
+
+
+def summarize(latencies, pixels):
+    latencies = numpy.sort(numpy.asarray(latencies))
+    median = percentile(latencies, 0.5)
+    return {
+        "count": len(latencies),
+        "p50": median,
+        "p90": percentile(latencies, 0.9),
+        "p99": percentile(latencies, 0.99),
+        "mean": float(latencies.mean()),
+        "min": float(latencies[0]),
+        "frames_per_second": 1.0 / median if median > 0 else None,
+        "megapixels_per_second": pixels / median / 1.0e6 if median > 0 else None,
+    }
+
+
+def read_process_status(key):
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(key + ":"):
+                return int(line.split()[1]) * 1024  # kB
+    raise KeyError(key)
+
+
+# Set the process's resident set high-water mark back to what is resident now (Linux 4.0 and
+# later). Returns whether it could be.
+def reset_peak_rss():
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except (IOError, OSError):
+        return False
+
+
+# Memory used at the peak of fn(), beyond what was in use before it. tracemalloc counts the numpy
+# arrays made by the call. Without it (Python 2) the growth of the resident set's high-water mark
+# is used, which is zero when the call fits in memory the process used earlier; so this is run in
+# a process of its own, by measure_peak_memory_in_subprocess, and on Linux the mark is reset first.
+def measure_peak_memory(fn):
+    gc.collect()
+    if tracemalloc is not None:
+        tracemalloc.start()
+        try:
+            fn()
+            return tracemalloc.get_traced_memory()[1], "tracemalloc"
+        finally:
+            tracemalloc.stop()
+    if reset_peak_rss():
+        before = read_process_status("VmRSS")
+        fn()
+        return read_process_status("VmHWM") - before, "vmhwm"
+    if resource is not None:
+        scale = 1 if sys.platform == "darwin" else 1024  # bytes on macOS, kilobytes elsewhere
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        fn()
+        return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before) * scale, "maxrss"
+    fn()
+    return None, None
+
+
+# Run this script again with --measure-memory name and the given options, and return the peak
+# bytes and method it reports, or None, None when it fails.
+def measure_peak_memory_in_subprocess(name, arguments):
+    command = [sys.executable, os.path.abspath(__file__), "--measure-memory", name] + arguments
+    try:
+        output = subprocess.check_output(command)
+        measurement = json.loads(output.decode("utf-8").strip().splitlines()[-1])
+    except (subprocess.CalledProcessError, OSError, ValueError, IndexError):
+        return None, None
+    return measurement["peak_bytes"], measurement["peak_method"]
+
+
+def run_case(case, repeat, warmup):
+    data = case.make_data()
+    operation = case.create_operation()
+    for _ in range(warmup):
+        operation.process(data)
+    latencies = list()
+    gc.collect()
+    for _ in range(repeat):
+        start = timer()
+        operation.process(data)
+        latencies.append(timer() - start)
+    return summarize(latencies, case.pixels)
+
+
+# The peak of a case's first call, in the --measure-memory process. The operation is new, so that
+# the peak includes making its caches.
+def run_case_peak_memory(case):
+    data = case.make_data()
+    operation = case.create_operation()
+    return measure_peak_memory(lambda: operation.process(data))
+
+
+def video_cases():
+    for backend in ("thread", "process"):
+        for width, height in VIDEO_SIZES:
+            yield "video_capture %s uint8 %dx%dx3" % (backend, height, width), backend, width, height
+
+
+def create_video_hardware_source(width, height):
+    import VideoCapture.VideoCapture as VideoCapture
+    hardware_source = VideoCapture.VideoCaptureHardwareSource()
+    hardware_source.video_capture_factory = functools.partial(VideoCapture.SyntheticVideoCapture, width, height)
+    hardware_source.target_frame_rate = 1000
+    hardware_source.duty_budget = 1.0
+    return hardware_source
+
+
+def acquire(hardware_source, count, latencies=None):
+    for _ in range(count):
+        start = timer()
+        hardware_source.acquire_data_elements()
+        if latencies is not None:
+            latencies.append(timer() - start)
+
+
+# Time the hardware source's acquisition loop: the latency of each acquire_data_elements call
+# (which is the wait for the next frame plus handing it over), the rate frames arrive at and how
+# many the capture loop dropped. The camera is a SyntheticVideoCapture that reads instantly and
+# the pacer is asked for far more frames than can be made, so this measures the loop itself.
+def run_video_case(backend, width, height, frame_count, warmup):
+    hardware_source = create_video_hardware_source(width, height)
+    latencies = list()
+    hardware_source.start_acquisition(None, {"backend": backend})
+    try:
+        acquire(hardware_source, warmup)
+        start = timer()
+        acquire(hardware_source, frame_count, latencies)
+        elapsed = timer() - start
+        telemetry = hardware_source.get_telemetry()
+    finally:
+        hardware_source.stop_acquisition()
+    result = summarize(latencies, width * height)
+    result["frames_per_second"] = frame_count / elapsed if elapsed > 0 else None
+    result["frames_dropped"] = telemetry.get("frames_dropped")
+    return result
+
+
+# The peak of starting acquisition, with its frame ring, and acquiring a tenth of frame_count
+# frames, in the --measure-memory process. Once running, the loop frees each frame before the
+# next, so it adds little.
+def run_video_case_peak_memory(backend, width, height, frame_count, warmup):
+    hardware_source = create_video_hardware_source(width, height)
+
+    def run():
+        hardware_source.start_acquisition(None, {"backend": backend})
+        acquire(hardware_source, warmup + max(frame_count // 10, 1))
+
+    try:
+        return measure_peak_memory(run)
+    finally:
+        hardware_source.stop_acquisition()
+
+
+def format_bytes(n):
+    if n is None:
+        return "n/a"
+    for unit in ("B", "KB", "MB"):
+        if abs(n) < 1024:
+            return "%d%s" % (n, unit)
+        n /= 1024.0
+    return "%.1fGB" % n
+
+
+def format_result(name, result, comparison=None):
+    line = "%-52s p50 %8.2fms  p90 %8.2fms  p99 %8.2fms  %8.1f fps  %8.1f Mpx/s  peak %8s" % (
+        name, result["p50"] * 1000, result["p90"] * 1000, result["p99"] * 1000,
+        result["frames_per_second"] or 0.0, result["megapixels_per_second"] or 0.0,
+        format_bytes(result.get("peak_bytes")))
+    if result.get("frames_dropped") is not None:
+        line += "  dropped %d" % result["frames_dropped"]
+    if comparison:
+        line += "  %s" % comparison
+    return line
+
+
+# Compare a result to the baseline's result for the same case by median latency. Returns the
+# text to show and whether it is a regression.
+def compare(result, baseline_result, threshold):
+    if baseline_result is None:
+        return "(new)", False
+    ratio = result["p50"] / baseline_result["p50"] if baseline_result["p50"] > 0 else 1.0
+    if ratio > 1.0 + threshold:
+        return "REGRESSION %.2fx slower" % ratio, True
+    if ratio < 1.0 / (1.0 + threshold):
+        return "%.2fx faster" % (1.0 / ratio), False
+    return "%.2fx" % ratio, False
+
+
+def environment():
+    return {
+        "python": platform.python_version(),
+        "numpy": numpy.__version__,
+        "machine": platform.machine(),
+        "platform": platform.platform(),
+    }
+
+
+def main(argv=None):
+    all_operations = ("double_gaussian_filter", "circle_ifft", "color_phase", "face_detection", "video_capture")
+    parser = argparse.ArgumentParser(description="Benchmark the processing operations and video capture.")
+    parser.add_argument("-o", "--operations", nargs="+", choices=all_operations, default=list(all_operations))
+    parser.add_argument("-s", "--sizes", nargs="+", type=int, default=list(SIZES), help="frame sizes (square)")
+    parser.add_argument("-r", "--repeat", type=int, default=REPEAT, help="timed calls per case")
+    parser.add_argument("-w", "--warmup", type=int, default=WARMUP, help="untimed calls per case first")
+    parser.add_argument("--video-frames", type=int, default=VIDEO_FRAMES, help="frames per video capture case")
+    parser.add_argument("--baseline", help="compare to the results in this file")
+    parser.add_argument("--save-baseline", help="write the results to this file")
+    parser.add_argument("--threshold", type=float, default=THRESHOLD,
+                        help="slowdown of the median, as a fraction, that counts as a regression")
+    parser.add_argument("--measure-memory", metavar="NAME", help=argparse.SUPPRESS)  # see run_case_peak_memory
+    options = parser.parse_args(argv)
+
+    sys.path.insert(0, TESTS_DIRECTORY)
+    import nion_stand_ins  # puts the plug-ins on the path, with stand-ins for nion when it isn't there
+    import CircleIFFT
+    import ColorPhase
+    import DoubleGaussianFilter
+
+    operations = set(options.operations)
+    if operations & set(("face_detection", "video_capture")):
+        if has_cv2():
+            import VideoCapture
+        else:
+            print("cv2 isn't available; skipping face detection and video capture")
+            operations -= set(("face_detection", "video_capture"))
+
+    cases = build_cases(operations, options.sizes)
+    if options.measure_memory:
+        measurement = None, None
+        for case in cases:
+            if case.name == options.measure_memory:
+                measurement = run_case_peak_memory(case)
+        for name, backend, width, height in video_cases():
+            if name == options.measure_memory and "video_capture" in operations:
+                measurement = run_video_case_peak_memory(backend, width, height, options.video_frames, options.warmup)
+        print(json.dumps({"peak_bytes": measurement[0], "peak_method": measurement[1]}))
+        return 0
+    case_arguments = ["-o"] + sorted(operations) + ["-s"] + [str(size) for size in options.sizes] + \
+        ["-w", str(options.warmup), "--video-frames", str(options.video_frames)]
+
+    baseline = dict()
+    if options.baseline:
+        with open(options.baseline) as f:
+            baseline = json.load(f)["results"]
+
+    print(" ".join("%s %s" % item for item in sorted(environment().items())))
+    results = dict()
+    regressions = list()
+
+    def report(name, result):
+        result["peak_bytes"], result["peak_method"] = measure_peak_memory_in_subprocess(name, case_arguments)
+        results[name] = result
+        comparison, regression = compare(result, baseline.get(name), options.threshold) if options.baseline else (None, False)
+        if regression:
+            regressions.append(name)
+        print(format_result(name, result, comparison))
+        sys.stdout.flush()
+
+    for case in cases:
+        report(case.name, run_case(case, options.repeat, options.warmup))
+    if "video_capture" in operations:
+        for name, backend, width, height in video_cases():
+            report(name, run_video_case(backend, width, height, options.video_frames, options.warmup))
+
+    if options.save_baseline:
+        with open(options.save_baseline, "w") as f:
+            json.dump({"environment": environment(), "results": results}, f, indent=2, sort_keys=True)
+    if regressions:
+        print("%d regression(s): %s" % (len(regressions), ", ".join(regressions)))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,124 @@
+"""
+    Puts the plug-ins on the path and, outside of Swift, installs small stand-ins for the parts of
+    nion.imaging and nion.swift that they use, so that the plug-in modules can be imported. The
+    benchmarks use them too.
+"""
+
+# standard libraries
+import os
+import sys
+import types
+
+# third party libraries
+import numpy
+
+
+PLUG_INS_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def make_module(name, **attributes):
+    module = types.ModuleType(name)
+    module.__dict__.update(attributes)
+    sys.modules[name] = module
+    return module
+
+
+class Operation(object):
+    # like nion's: values live in a dict, set from the description's defaults and by set_property,
+    # not in the operation's attributes.
+
+    def __init__(self, name, operation_id, description=None):
+        self.name = name
+        self.operation_id = operation_id
+        self.description = description or list()
+        self.values = dict((item["property"], item.get("default")) for item in self.description)
+
+    def get_property(self, property_id, default_value=None):
+        return self.values.get(property_id, default_value)
+
+    def set_property(self, property_id, value):
+        self.values[property_id] = value
+
+
+class OperationManager(object):
+    operations = dict()
+
+    def register_operation(self, operation_id, create_operation):
+        OperationManager.operations[operation_id] = create_operation
+
+    def build_operation(self, operation_id):
+        return OperationManager.operations[operation_id]()
+
+
+class HardwareSource(object):
+
+    def __init__(self, hardware_source_id, display_name):
+        self.hardware_source_id = hardware_source_id
+        self.display_name = display_name
+
+
+class HardwareSourceManager(object):
+    hardware_sources = list()
+
+    def register_hardware_source(self, hardware_source):
+        HardwareSourceManager.hardware_sources.append(hardware_source)
+
+
+class Application(object):
+
+    def __init__(self):
+        self.menu_handlers = list()
+
+    def register_menu_handler(self, handler):
+        self.menu_handlers.append(handler)
+
+
+def is_data_rgb(data):
+    return data is not None and data.dtype == numpy.uint8 and data.ndim == 3 and data.shape[2] in (3, 4)
+
+
+def create_rgba_image_from_array(data):
+    if data.ndim == 3 and data.shape[2] in (3, 4):
+        rgba = numpy.empty(data.shape[:2], numpy.uint32)
+        view = rgba.view(numpy.uint8).reshape(data.shape[:2] + (4,))
+        view[..., :3] = data[..., :3]
+        view[..., 3] = 255
+        return rgba
+    data = numpy.abs(data) if numpy.iscomplexobj(data) else data
+    low, high = data.min(), data.max()
+    gray = ((data - low) * (255.0 / (high - low) if high > low else 0.0)).astype(numpy.uint32)
+    return numpy.uint32(0xFF000000) | (gray << 16) | (gray << 8) | gray
+
+
+def install():
+    if PLUG_INS_DIRECTORY not in sys.path:
+        sys.path.insert(0, PLUG_INS_DIRECTORY)
+    try:
+        import nion.imaging.Operation
+        import nion.swift.Application
+        return  # running with the real thing
+    except ImportError:
+        pass
+    nion = make_module("nion")
+    imaging = make_module("nion.imaging")
+    swift = make_module("nion.swift")
+    nion.imaging, nion.swift = imaging, swift
+    imaging.Image = make_module("nion.imaging.Image",
+                                is_data_1d=lambda data: data is not None and data.ndim == 1,
+                                is_data_2d=lambda data: data is not None and data.ndim == 2,
+                                is_data_3d=lambda data: data is not None and data.ndim == 3,
+                                is_data_rgb=is_data_rgb,
+                                is_data_complex_type=lambda data: data is not None and numpy.iscomplexobj(data),
+                                is_data_scalar_type=lambda data: data is not None and not numpy.iscomplexobj(data) and not is_data_rgb(data),
+                                create_rgba_image_from_array=create_rgba_image_from_array)
+    imaging.Operation = make_module("nion.imaging.Operation", Operation=Operation,
+                                    OperationManager=OperationManager)
+    swift.Application = make_module("nion.swift.Application", app=Application())
+    swift.HardwareSource = make_module("nion.swift.HardwareSource", HardwareSource=HardwareSource,
+                                       HardwareSourceManager=HardwareSourceManager)
+    swift.Decorators = make_module("nion.swift.Decorators",
+                                   relative_file=lambda parent, name: os.path.join(os.path.dirname(parent), name))
+    swift.DataItem = make_module("nion.swift.DataItem")
+
+
+install()
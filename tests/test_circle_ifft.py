@@ -0,0 +1,63 @@
+"""
+    Tests of the Circle IFFT operation on single frames and on stacks of them.
+
+    python -m unittest discover -s tests     (from the PlugIns directory)
+"""
+
+# standard libraries
+import threading
+import unittest
+
+# third party libraries
+import numpy
+
+import nion_stand_ins
+
+from CircleIFFT import CircleIFFT
+
+
+def make_spectrum(shape, seed=0):
+    random = numpy.random.RandomState(seed)
+    return random.normal(size=shape) + 1j * random.normal(size=shape)
+
+
+@unittest.skipIf(CircleIFFT.StackProcessor is None, "StackProcessing needs Python 2")
+class TestStacks(unittest.TestCase):
+
+    def test_stack_is_done_frame_by_frame(self):
+        data = numpy.array([make_spectrum((64, 64), seed) for seed in range(4)])
+        operation = CircleIFFT.CircleIFFTOperation()
+        operation.output_size = "auto"
+        result = operation.process(data)
+        self.assertEqual(result.shape, (4, 64, 64))
+        for i in range(len(data)):
+            frame_operation = CircleIFFT.CircleIFFTOperation()
+            frame_operation.output_size = "auto"
+            self.assertTrue(numpy.allclose(result[i], frame_operation.process(data[i])))
+
+    def test_operations_doing_stacks_at_the_same_time_keep_their_own_settings(self):
+        data = numpy.array([make_spectrum((64, 64), seed) for seed in range(20)])
+        operations = [CircleIFFT.CircleIFFTOperation() for i in range(2)]
+        operations[0].output_size = "auto"
+        expected = [operation.process(data) for operation in operations]
+        self.assertEqual([result.shape for result in expected], [(20, 64, 64), (20, 512, 512)])
+        failures = list()
+
+        def process_stacks(operation, expected_result):
+            for i in range(5):
+                try:
+                    if not numpy.allclose(operation.process(data), expected_result):
+                        failures.append(operation.output_size)
+                except ValueError as e:
+                    failures.append(str(e))
+
+        threads = [threading.Thread(target=process_stacks, args=item) for item in zip(operations, expected)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(failures, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,198 @@
+"""
+    Tests that the double Gaussian filter engine gives the results of the original implementation
+    (a full complex fft2 with fftshift and a kernel over the whole plane), with both backends and
+    in both precisions.
+
+    python -m unittest discover -s tests     (from the PlugIns directory)
+"""
+
+# standard libraries
+import math
+import threading
+import unittest
+
+# third party libraries
+import numpy
+import scipy.fftpack
+
+import nion_stand_ins
+
+from DoubleGaussianFilter import DoubleGaussianFilter
+from DoubleGaussianFilter.DoubleGaussianFilter import DoubleGaussianFilterEngine
+
+
+SHAPES = ((64, 64), (65, 65), (128, 128), (127, 127))  # even and odd
+PARAMETERS = ((0.3, 0.3, 0.3), (0.1, 0.4, 0.5), (0.5, 0.2, 0.0), (0.05, 0.02, 0.7))
+
+
+# the filter as it was first written, before the engine.
+def reference_filter(data, sigma1, sigma2, weight2):
+    fft_data = scipy.fftpack.fftshift(scipy.fftpack.fft2(data.copy()))
+    yy_min = int(math.floor(-data.shape[0] / 2.0))
+    yy_max = int(math.floor(data.shape[0] / 2.0))
+    xx_min = int(math.floor(-data.shape[1] / 2.0))
+    xx_max = int(math.floor(data.shape[1] / 2.0))
+    xx, yy = numpy.meshgrid(numpy.linspace(yy_min, yy_max, data.shape[0]),
+                            numpy.linspace(xx_min, xx_max, data.shape[1]))
+    rr = numpy.sqrt(numpy.square(xx) + numpy.square(yy)) / (data.shape[0] * 0.5)
+    kernel = numpy.exp(-0.5 * numpy.square(rr / sigma1)) - (1.0 - weight2) * numpy.exp(-0.5 * numpy.square(rr / sigma2))
+    return scipy.fftpack.ifft2(scipy.fftpack.ifftshift(fft_data * kernel)).real
+
+
+def make_data(shape, dtype=numpy.float64):
+    random = numpy.random.RandomState(shape[0])
+    y, x = numpy.ogrid[0:shape[0], 0:shape[1]]
+    return (numpy.sin(x * 0.3) * numpy.cos(y * 0.2) + random.normal(0.0, 0.5, shape)).astype(dtype)
+
+
+class DoubleGaussianFilterTestCase(unittest.TestCase):
+
+    def assertMatchesReference(self, result, data, parameters, tolerance):
+        expected = reference_filter(data, *parameters)
+        self.assertEqual(result.shape, expected.shape)
+        scale = numpy.abs(expected).max()
+        error = numpy.abs(result - expected).max() / scale
+        self.assertLess(error, tolerance, "%s %s: relative error %g" % (data.shape, parameters, error))
+
+
+class TestFFTBackend(DoubleGaussianFilterTestCase):
+
+    def test_double_precision_matches_original(self):
+        for shape in SHAPES:
+            data = make_data(shape)
+            engine = DoubleGaussianFilterEngine(backend="fft")
+            for parameters in PARAMETERS:
+                result = engine.filter(data, *parameters)
+                self.assertEqual(result.dtype, numpy.float64)
+                self.assertMatchesReference(result, data, parameters, 1e-10)
+
+    def test_single_precision_matches_original(self):
+        for shape in SHAPES:
+            data = make_data(shape, numpy.float32)
+            engine = DoubleGaussianFilterEngine(backend="fft", single_precision=True)
+            for parameters in PARAMETERS:
+                result = engine.filter(data, *parameters)
+                self.assertEqual(result.dtype, numpy.float32)
+                self.assertMatchesReference(result, data.astype(numpy.float64), parameters, 1e-4)
+
+    def test_integer_data_matches_original(self):
+        data = (make_data((64, 64)) * 1000).astype(numpy.int16)
+        result = DoubleGaussianFilterEngine(backend="fft").filter(data, 0.3, 0.2, 0.4)
+        self.assertMatchesReference(result, data.astype(numpy.float64), (0.3, 0.2, 0.4), 1e-10)
+
+
+class TestSeparableBackend(DoubleGaussianFilterTestCase):
+
+    def test_double_precision_matches_original(self):
+        for shape in SHAPES:
+            data = make_data(shape)
+            engine = DoubleGaussianFilterEngine(backend="separable")
+            for parameters in PARAMETERS:
+                self.assertMatchesReference(engine.filter(data, *parameters), data, parameters, 1e-5)
+
+    def test_single_precision_matches_original(self):
+        for shape in SHAPES:
+            data = make_data(shape, numpy.float32)
+            engine = DoubleGaussianFilterEngine(backend="separable", single_precision=True)
+            for parameters in PARAMETERS:
+                result = engine.filter(data, *parameters)
+                self.assertEqual(result.dtype, numpy.float32)
+                self.assertMatchesReference(result, data.astype(numpy.float64), parameters, 1e-4)
+
+    def test_bands_match_original(self):
+        band_bytes = DoubleGaussianFilter.SEPARABLE_BAND_BYTES
+        DoubleGaussianFilter.SEPARABLE_BAND_BYTES = 16 * 65 * 8  # a few rows at a time
+        try:
+            data = make_data((65, 65))
+            engine = DoubleGaussianFilterEngine(backend="separable")
+            self.assertMatchesReference(engine.filter(data, 0.3, 0.2, 0.4), data, (0.3, 0.2, 0.4), 1e-5)
+        finally:
+            DoubleGaussianFilter.SEPARABLE_BAND_BYTES = band_bytes
+
+    def test_filters_into_out(self):
+        data = make_data((65, 65))
+        out = numpy.zeros(data.shape)
+        result = DoubleGaussianFilterEngine(backend="separable").filter(data, 0.3, 0.2, 0.4, out)
+        self.assertIs(result, out)
+        self.assertMatchesReference(out, data, (0.3, 0.2, 0.4), 1e-5)
+
+
+class TestBackendSelection(DoubleGaussianFilterTestCase):
+
+    def test_fft_is_the_default(self):
+        self.assertEqual(DoubleGaussianFilterEngine().backend, "fft")
+        self.assertEqual(DoubleGaussianFilter.DoubleGaussianFilterOperation().engine.backend, "fft")
+
+    def test_unknown_backend_is_an_error(self):
+        with self.assertRaises(ValueError):
+            DoubleGaussianFilterEngine(backend="auto").filter(make_data((64, 64)), 0.3, 0.3, 0.3)
+
+
+class TestOperation(DoubleGaussianFilterTestCase):
+
+    def test_process_uses_property_values(self):
+        operation = DoubleGaussianFilter.DoubleGaussianFilterOperation()
+        operation.set_property("sigma1", 0.2)
+        operation.set_property("sigma2", 0.1)
+        operation.set_property("weight2", 0.6)
+        data = make_data((64, 64))
+        self.assertMatchesReference(operation.process(data), data, (0.2, 0.1, 0.6), 1e-5)
+
+
+@unittest.skipIf(DoubleGaussianFilter.StackProcessor is None, "StackProcessing needs Python 2")
+class TestStacks(DoubleGaussianFilterTestCase):
+
+    def setUp(self):
+        self.pool_minimum_pixels = DoubleGaussianFilter.StackProcessor.POOL_MINIMUM_PIXELS
+
+    def tearDown(self):
+        DoubleGaussianFilter.StackProcessor.POOL_MINIMUM_PIXELS = self.pool_minimum_pixels
+
+    def make_stack(self, frame_count, shape=(64, 64)):
+        return numpy.array([make_data(shape) * (i + 1) for i in range(frame_count)])
+
+    def assertStackMatchesReference(self, result, data, parameters):
+        self.assertEqual(result.shape, data.shape)
+        for i in range(len(data)):
+            self.assertMatchesReference(result[i], data[i], parameters, 1e-5)
+
+    def test_stack_matches_original_frame_by_frame(self):
+        data = self.make_stack(5, (65, 65))
+        operation = DoubleGaussianFilter.DoubleGaussianFilterOperation()
+        operation.set_property("sigma1", 0.2)
+        self.assertStackMatchesReference(operation.process(data), data, (0.2, 0.3, 0.3))
+
+    def test_stack_on_the_pool_matches_original(self):
+        DoubleGaussianFilter.StackProcessor.POOL_MINIMUM_PIXELS = 1
+        data = self.make_stack(6)
+        operation = DoubleGaussianFilter.DoubleGaussianFilterOperation()
+        operation.stack_workers = 2
+        progress = list()
+        operation.progress = lambda done, count: progress.append(done)
+        self.assertStackMatchesReference(operation.process(data), data, (0.3, 0.3, 0.3))
+        self.assertEqual(progress[-1], 6)
+
+    def test_operations_filtering_stacks_at_the_same_time_keep_their_own_settings(self):
+        data = self.make_stack(20, (256, 256))
+        operations = [DoubleGaussianFilter.DoubleGaussianFilterOperation() for i in range(2)]
+        operations[0].set_property("sigma1", 0.1)
+        operations[1].set_property("sigma1", 0.4)
+        operations[1].engine.single_precision = True
+        expected = [operation.process(data) for operation in operations]
+        failures = list()
+
+        def filter_stacks(operation, expected_result):
+            for i in range(5):
+                if not numpy.allclose(operation.process(data), expected_result, rtol=0, atol=1e-4 * numpy.abs(expected_result).max()):
+                    failures.append(operation.get_property("sigma1"))
+
+        threads = [threading.Thread(target=filter_stacks, args=item) for item in zip(operations, expected)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(failures, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,84 @@
+"""
+    Tests of the operation profiling hooks.
+
+    python -m unittest discover -s tests     (from the PlugIns directory)
+"""
+
+# standard libraries
+import logging
+import unittest
+
+# third party libraries
+import numpy
+
+import nion_stand_ins
+
+from nion.imaging import Operation
+
+try:
+    from Profiling import Profiler
+except ImportError:  # the plug-in packages use Python 2 imports
+    Profiler = None
+
+
+class FilterOperation(Operation.Operation):
+
+    def __init__(self):
+        description = [{"name": "Sigma", "property": "sigma", "type": "scalar", "default": 0.3}]
+        super(FilterOperation, self).__init__("Filter", "filter-operation", description)
+        self.scale = numpy.float32(2.0)
+
+    def process(self, data):
+        return data * self.get_property("sigma")
+
+
+@unittest.skipIf(Profiler is None, "Profiling needs Python 2")
+class TestProfiler(unittest.TestCase):
+
+    def setUp(self):
+        Profiler.profiler.clear()
+
+    def tearDown(self):
+        Profiler.profiler.disable()
+        Profiler.profiler.clear()
+
+    def test_nothing_is_recorded_while_disabled(self):
+        operation = Profiler.instrument(FilterOperation())
+        operation.process(numpy.ones((4, 4)))
+        self.assertEqual(Profiler.profiler.get_records(), [])
+
+    def test_records_property_values_in_use(self):
+        operation = Profiler.instrument(FilterOperation(), parameters=("sigma", "scale"))
+        Profiler.profiler.enable()
+        operation.set_property("sigma", 0.7)
+        result = operation.process(numpy.ones((4, 5), numpy.float32))
+        self.assertTrue(numpy.all(result == numpy.float32(0.7)))
+        records = Profiler.profiler.get_records("filter-operation")
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0]["parameters"], {"sigma": 0.7, "scale": 2.0})
+        self.assertEqual(records[0]["shape"], [4, 5])
+        self.assertEqual(records[0]["dtype"], "float32")
+        self.assertEqual(Profiler.profiler.summary()["filter-operation"]["calls"], 1)
+
+    @unittest.skipIf(Profiler and Profiler.tracemalloc, "tracemalloc is available")
+    def test_memory_tracing_without_tracemalloc_warns_and_records_times(self):
+        operation = Profiler.instrument(FilterOperation())
+        logger = logging.getLogger()
+        messages = list()
+        handler = logging.Handler()
+        handler.emit = lambda record: messages.append(record.getMessage())
+        logger.addHandler(handler)
+        try:
+            Profiler.profiler.enable(trace_memory=True)
+        finally:
+            logger.removeHandler(handler)
+        self.assertEqual(len(messages), 1)
+        self.assertFalse(Profiler.profiler.trace_memory)
+        operation.process(numpy.ones((4, 4)))
+        record = Profiler.profiler.get_records()[0]
+        self.assertIn("duration", record)
+        self.assertNotIn("allocated_bytes", record)
+
+
+if __name__ == "__main__":
+    unittest.main()
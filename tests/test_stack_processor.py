@@ -0,0 +1,138 @@
+"""
+    Tests of processing 3-D stacks frame by frame, here and on the pool of worker processes.
+
+    python -m unittest discover -s tests     (from the PlugIns directory)
+"""
+
+# standard libraries
+import functools
+import logging
+import unittest
+
+# third party libraries
+import numpy
+
+import nion_stand_ins
+
+try:
+    from StackProcessing import StackProcessor
+except ImportError:  # the plug-in packages use Python 2 imports
+    StackProcessor = None
+
+
+WORKER_OFFSET = 1000
+
+
+# doubles each frame, adding WORKER_OFFSET in a worker process so the tests can tell where it was done.
+def double_frames(frames, out):
+    offset = WORKER_OFFSET if StackProcessor.in_worker() else 0
+    for i in range(len(frames)):
+        out[i] = frames[i] * 2 + offset
+
+
+def sum_rows(frames, out):
+    for i in range(len(frames)):
+        out[i] = frames[i].sum(axis=0, dtype=numpy.float32)
+
+
+def record_frames(calls, frames, out):
+    calls.append(len(frames))
+    double_frames(frames, out)
+
+
+def make_stack(frame_count, size=4):
+    return numpy.arange(frame_count * size * size, dtype=numpy.int32).reshape((frame_count, size, size))
+
+
+@unittest.skipIf(StackProcessor is None, "StackProcessing needs Python 2")
+class TestProcessStack(unittest.TestCase):
+
+    def setUp(self):
+        self.pool_minimum_pixels = StackProcessor.POOL_MINIMUM_PIXELS
+
+    def tearDown(self):
+        StackProcessor.POOL_MINIMUM_PIXELS = self.pool_minimum_pixels
+
+    def test_small_stack_is_done_here_in_chunks(self):
+        data = make_stack(10)
+        calls = list()
+        progress = list()
+        out = StackProcessor.process_stack(data, double_frames, workers=2, chunk_size=3,
+                                           progress=lambda done, count: progress.append((done, count)),
+                                           local_process_frames=functools.partial(record_frames, calls))
+        self.assertTrue(numpy.array_equal(out, data * 2))
+        self.assertEqual(calls, [1, 3, 3, 3])
+        self.assertEqual(progress, [(1, 10), (4, 10), (7, 10), (10, 10)])
+
+    def test_result_shape_and_dtype_follow_the_first_frame(self):
+        data = make_stack(5, 6)
+        out = StackProcessor.process_stack(data, sum_rows)
+        self.assertEqual(out.shape, (5, 6))
+        self.assertEqual(out.dtype, numpy.float32)
+        self.assertTrue(numpy.array_equal(out, data.sum(axis=1)))
+
+    def test_large_stack_is_done_on_the_pool(self):
+        StackProcessor.POOL_MINIMUM_PIXELS = 1
+        data = make_stack(9)
+        calls = list()
+        progress = list()
+        out = StackProcessor.process_stack(data, double_frames, workers=2,
+                                           progress=lambda done, count: progress.append((done, count)),
+                                           local_process_frames=functools.partial(record_frames, calls))
+        # only the first frame is done here; the rest are done by the workers, through shared memory.
+        self.assertEqual(calls, [1])
+        self.assertTrue(numpy.array_equal(out[0], data[0] * 2))
+        self.assertTrue(numpy.array_equal(out[1:], data[1:] * 2 + WORKER_OFFSET))
+        self.assertEqual(progress[0], (1, 9))
+        self.assertEqual(progress[-1], (9, 9))
+        self.assertEqual([done for done, count in progress], sorted(done for done, count in progress))
+        self.assertFalse(StackProcessor.in_worker())
+
+    def test_empty_stack_is_an_error(self):
+        with self.assertRaises(ValueError):
+            StackProcessor.process_stack(numpy.zeros((0, 4, 4)), double_frames)
+
+
+@unittest.skipIf(StackProcessor is None, "StackProcessing needs Python 2")
+class TestProgressLog(unittest.TestCase):
+
+    def setUp(self):
+        self.messages = list()
+        self.handler = logging.Handler()
+        self.handler.emit = lambda record: self.messages.append(record.getMessage())
+        self.logger = logging.getLogger()
+        self.level = self.logger.level
+        self.logger.setLevel(logging.INFO)
+        self.logger.addHandler(self.handler)
+
+    def tearDown(self):
+        self.logger.removeHandler(self.handler)
+        self.logger.setLevel(self.level)
+
+    def test_long_stacks_are_logged(self):
+        StackProcessor.process_stack(make_stack(4), double_frames, chunk_size=1,
+                                     progress=StackProcessor.ProgressLog("Doubling", interval=0))
+        self.assertEqual(self.messages, ["Doubling: %d of 4 frames" % done for done in range(1, 5)])
+
+    def test_quick_stacks_are_not_logged(self):
+        StackProcessor.process_stack(make_stack(4), double_frames, progress=StackProcessor.ProgressLog("Doubling"))
+        self.assertEqual(self.messages, [])
+
+    def test_operations_log_progress_unless_given_a_progress_function(self):
+        from DoubleGaussianFilter import DoubleGaussianFilter
+        interval = StackProcessor.PROGRESS_LOG_INTERVAL
+        StackProcessor.PROGRESS_LOG_INTERVAL = 0
+        try:
+            operation = DoubleGaussianFilter.DoubleGaussianFilterOperation()
+            operation.process(numpy.ones((3, 8, 8)))
+            self.assertEqual(self.messages[-1], "Double Gaussian Filter: 3 of 3 frames")
+            del self.messages[:]
+            operation.progress = lambda done, count: None
+            operation.process(numpy.ones((3, 8, 8)))
+            self.assertEqual(self.messages, [])
+        finally:
+            StackProcessor.PROGRESS_LOG_INTERVAL = interval
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,50 @@
+"""
+    Tests of the time lapse stack files.
+
+    python -m unittest discover -s tests     (from the PlugIns directory)
+"""
+
+# standard libraries
+import os
+import shutil
+import tempfile
+import unittest
+
+# third party libraries
+import numpy
+
+import nion_stand_ins
+
+from TimeLapse import TimeLapse
+
+
+class TestStackFile(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_runs_started_in_the_same_second_get_their_own_files(self):
+        paths = [TimeLapse.create_stack_file(self.directory) for i in range(3)]
+        self.assertEqual(len(set(paths)), 3)
+        for path in paths:
+            self.assertEqual(os.path.dirname(path), self.directory)
+            self.assertTrue(os.path.basename(path).startswith("Time Lapse "))
+            self.assertTrue(path.endswith(".npy"))
+            self.assertEqual(os.path.getsize(path), 0)
+
+    def test_a_new_stack_leaves_an_earlier_one_intact(self):
+        first = numpy.lib.format.open_memmap(TimeLapse.create_stack_file(self.directory), mode="w+",
+                                             dtype=numpy.uint8, shape=(2, 4, 4))
+        first[...] = 7
+        second = numpy.lib.format.open_memmap(TimeLapse.create_stack_file(self.directory), mode="w+",
+                                              dtype=numpy.uint8, shape=(2, 4, 4))
+        second[...] = 9
+        self.assertTrue(numpy.all(first == 7))
+        del first, second
+
+
+if __name__ == "__main__":
+    unittest.main()
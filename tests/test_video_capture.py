@@ -0,0 +1,222 @@
+"""
+    Tests of the frame ring and of both video capture backends, with SyntheticVideoCapture standing
+    in for the camera.
+
+    python -m unittest discover -s tests     (from the PlugIns directory)
+"""
+
+# standard libraries
+import multiprocessing
+import os
+import threading
+import time
+import unittest
+
+# third party libraries
+import numpy
+
+import nion_stand_ins
+
+try:
+    import cv2
+except ImportError:
+    cv2 = None
+
+if cv2 is not None:
+    from VideoCapture import VideoCapture
+
+
+FRAME_WIDTH = 64
+FRAME_HEIGHT = 48
+
+
+def synthetic_capture_factory():
+    return VideoCapture.SyntheticVideoCapture(FRAME_WIDTH, FRAME_HEIGHT, read_time=0.002)
+
+
+PARENT_PROCESS_ID = os.getpid()
+
+
+# opens the camera here, so start_acquisition can read the frame size, but fails in the capture process.
+def failing_in_child_factory():
+    if os.getpid() != PARENT_PROCESS_ID:
+        raise RuntimeError("no camera")
+    return synthetic_capture_factory()
+
+
+def write_frame(ring, value):
+    reservation = ring.begin_write()
+    if reservation is None:
+        return None
+    slot, buffer = reservation
+    buffer[...] = value
+    ring.end_write(slot)
+    return slot
+
+
+@unittest.skipIf(cv2 is None, "VideoCapture needs cv2")
+class TestFrameRing(unittest.TestCase):
+
+    def test_latest_policy_gives_newest_frame_and_counts_skipped_frames(self):
+        ring = VideoCapture.FrameRing((2, 2), numpy.uint8, 4, "latest")
+        for value in (1, 2, 3):
+            write_frame(ring, value)
+        frame = ring.borrow(0)
+        self.assertEqual(frame.sequence, 3)
+        self.assertTrue(numpy.all(frame.data == 3))
+        ring.release(frame)
+        self.assertEqual((ring.captured_count, ring.delivered_count, ring.dropped_count), (3, 1, 2))
+        self.assertIsNone(ring.borrow(0))  # the older frames are gone
+
+    def test_latest_policy_overwrites_oldest_unread_frame_when_full(self):
+        ring = VideoCapture.FrameRing((2, 2), numpy.uint8, 2, "latest")
+        for value in (1, 2, 3):
+            self.assertIsNotNone(write_frame(ring, value))
+        self.assertEqual((ring.overrun_count, ring.dropped_count), (1, 1))
+        frame = ring.borrow(0)
+        self.assertEqual(frame.sequence, 3)
+        ring.release(frame)
+
+    def test_every_policy_delivers_in_order_and_drops_new_frames_when_full(self):
+        ring = VideoCapture.FrameRing((2, 2), numpy.uint8, 2, "every")
+        self.assertIsNotNone(write_frame(ring, 1))
+        self.assertIsNotNone(write_frame(ring, 2))
+        self.assertIsNone(write_frame(ring, 3))
+        self.assertEqual((ring.overrun_count, ring.dropped_count), (1, 1))
+        sequences = list()
+        for i in range(2):
+            frame = ring.borrow(0)
+            sequences.append(frame.sequence)
+            self.assertTrue(numpy.all(frame.data == frame.sequence))
+            ring.release(frame)
+        self.assertEqual(sequences, [1, 2])
+
+    def test_borrowed_slot_is_never_written(self):
+        ring = VideoCapture.FrameRing((2, 2), numpy.uint8, 3, "latest")
+        write_frame(ring, 1)
+        frame = ring.borrow(0)
+        for value in range(2, 10):
+            self.assertNotEqual(write_frame(ring, value), frame.slot)
+        self.assertTrue(numpy.all(frame.data == 1))
+        ring.release(frame)
+
+    def test_failed_write_frees_the_slot(self):
+        ring = VideoCapture.FrameRing((2, 2), numpy.uint8, 2, "every")
+        slot, buffer = ring.begin_write()
+        ring.end_write(slot, False)
+        self.assertIsNone(ring.borrow(0))
+        self.assertEqual(ring.captured_count, 0)
+        self.assertIsNotNone(write_frame(ring, 1))
+        self.assertIsNotNone(write_frame(ring, 2))
+
+    def test_detach_keeps_the_buffer_and_gives_the_ring_a_new_one(self):
+        ring = VideoCapture.FrameRing((2, 2), numpy.uint8, 2, "latest")
+        write_frame(ring, 7)
+        data = ring.detach(ring.borrow(0))
+        for value in range(8, 12):
+            write_frame(ring, value)
+        self.assertTrue(numpy.all(data == 7))
+
+    def test_borrow_times_out_and_close_wakes_a_waiting_consumer(self):
+        ring = VideoCapture.FrameRing((2, 2), numpy.uint8)
+        start = time.time()
+        self.assertIsNone(ring.borrow(0.05))
+        self.assertGreaterEqual(time.time() - start, 0.04)
+        results = list()
+        thread = threading.Thread(target=lambda: results.append(ring.borrow()))
+        thread.start()
+        time.sleep(0.05)
+        ring.close()
+        thread.join(1.0)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(results, [None])
+
+    def test_consumer_turnaround_does_not_count_waiting(self):
+        ring = VideoCapture.FrameRing((2, 2), numpy.uint8)
+        for i in range(5):
+            threading.Timer(0.05, write_frame, (ring, i)).start()
+            frame = ring.borrow(1.0)  # waits about 50ms
+            ring.release(frame)
+        self.assertLess(ring.consumer_turnaround, 0.02)
+
+
+@unittest.skipIf(cv2 is None, "VideoCapture needs cv2")
+class TestFramePacer(unittest.TestCase):
+
+    def test_invalid_settings_are_rejected(self):
+        for target_frame_rate, duty_budget in ((0, 0.5), (-1, 0.5), (20, 0), (20, 1.5)):
+            with self.assertRaises(ValueError):
+                VideoCapture.FramePacer(target_frame_rate, duty_budget)
+
+    def test_delay_follows_a_slow_consumer(self):
+        pacer = VideoCapture.FramePacer(20, 1.0, lambda: 0.2)
+        self.assertAlmostEqual(pacer.next_delay(0.001, 0.002), 0.198, places=3)
+
+
+class VideoCaptureBackendTests(object):
+    backend = None
+
+    def setUp(self):
+        self.hardware_source = VideoCapture.VideoCaptureHardwareSource()
+        self.hardware_source.video_capture_factory = synthetic_capture_factory
+        self.hardware_source.target_frame_rate = 200
+        self.hardware_source.duty_budget = 1.0
+        self.threads_before = threading.active_count()
+
+    def start(self):
+        self.hardware_source.start_acquisition(None, {"backend": self.backend})
+
+    def test_frames_are_delivered_in_sequence_and_untorn(self):
+        ramp = VideoCapture.SyntheticVideoCapture(FRAME_WIDTH, FRAME_HEIGHT).read()[1].astype(int) - 1
+        self.start()
+        try:
+            sequences = list()
+            for i in range(20):
+                data_elements = self.hardware_source.acquire_data_elements()
+                self.assertEqual(len(data_elements), 1)
+                data = data_elements[0]["data"]
+                self.assertEqual(data.shape, (FRAME_HEIGHT, FRAME_WIDTH, 3))
+                self.assertEqual(data.dtype, numpy.uint8)
+                # every pixel is the ramp moved on by the same number of frames
+                offsets = numpy.unique((data.astype(int) - ramp) % 256)
+                self.assertEqual(len(offsets), 1)
+                sequences.append(data_elements[0]["properties"]["frame_sequence"])
+        finally:
+            self.hardware_source.stop_acquisition()
+        self.assertEqual(sequences, sorted(set(sequences)))
+        telemetry = self.hardware_source.get_telemetry()
+        self.assertEqual(telemetry["frames_delivered"], 20)
+        self.assertGreaterEqual(telemetry["frames_captured"], 20)
+
+    def test_stop_acquisition_stops_capture_and_wakes_the_consumer(self):
+        self.start()
+        self.hardware_source.acquire_data_elements()
+        self.hardware_source.stop_acquisition()
+        self.assertEqual(self.hardware_source.acquire_data_elements(), [])
+        deadline = time.time() + 2.0
+        while threading.active_count() > self.threads_before and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(threading.active_count(), self.threads_before)
+        self.assertEqual(multiprocessing.active_children(), [])
+
+
+@unittest.skipIf(cv2 is None, "VideoCapture needs cv2")
+class TestThreadBackend(VideoCaptureBackendTests, unittest.TestCase):
+    backend = "thread"
+
+
+@unittest.skipIf(cv2 is None, "VideoCapture needs cv2")
+class TestProcessBackend(VideoCaptureBackendTests, unittest.TestCase):
+    backend = "process"
+
+    def test_consumer_is_woken_when_the_capture_process_dies(self):
+        self.hardware_source.video_capture_factory = failing_in_child_factory
+        self.start()
+        start = time.time()
+        self.assertEqual(self.hardware_source.acquire_data_elements(), [])
+        self.assertLess(time.time() - start, VideoCapture.TIMEOUT)
+        self.hardware_source.stop_acquisition()
+
+
+if __name__ == "__main__":
+    unittest.main()